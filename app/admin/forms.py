@@ -1,7 +1,9 @@
 from flask_wtf import FlaskForm  # 表单基类
-from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField, FileField, SelectMultipleField
+from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField, FileField, SelectMultipleField, \
+    HiddenField
 from wtforms.validators import DataRequired, ValidationError, EqualTo
-from app.models import Admin, Tag, Auth, Role
+from app import catalog
+from app.models import Admin
 
 
 class LoginFrom(FlaskForm):
@@ -87,6 +89,7 @@ class MovieForm(FlaskForm):
         ],
         description='电影文件',
     )
+    upload_id = HiddenField()  # 分片上传电影文件时，上传完成后的上传id
     info = TextAreaField(
         label='简介',
         validators=[
@@ -133,7 +136,7 @@ class MovieForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super(MovieForm, self).__init__(*args, **kwargs)
-        self.tag_id.choices = [(v.id, v.name) for v in Tag.query.all()]
+        self.tag_id.choices = [(v['id'], v['name']) for v in catalog.tags()]
 
     area = StringField(
         label='上映地区',
@@ -308,7 +311,7 @@ class RoleForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super(RoleForm, self).__init__(*args, **kwargs)
-        self.auths.choices = [(item.id, item.name) for item in Auth.query.all()]
+        self.auths.choices = [(item_id, name) for item_id, name in catalog.auths()]
 
 
 class AdminForm(FlaskForm):
@@ -377,7 +380,7 @@ class AdminForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super(AdminForm, self).__init__(*args, **kwargs)
-        self.role_id.choices = [(v.id, v.name) for v in Role.query.all()]
+        self.role_id.choices = [(role_id, name) for role_id, name in catalog.roles()]
 
     submit = SubmitField(
         label='提交',
@@ -0,0 +1,46 @@
+from app import db, rd
+from app.models import Auth, Role
+
+# 权限版本号，修改角色或权限时加1，各个进程发现版本号变化后清空本地缓存
+PERMISSION_VERSION_KEY = "admin:permission:version"
+
+# 本进程缓存的角色权限：{角色id: 允许访问的路由集合}
+_role_urls = {}
+_version = None
+
+
+def invalidate():
+    """角色或权限变化时调用，所有进程的缓存都会失效"""
+    rd.incr(PERMISSION_VERSION_KEY)
+
+
+def _check_version():
+    """版本号和本地缓存的不一致时清空本地缓存"""
+    global _version
+    version = rd.get(PERMISSION_VERSION_KEY)
+    if version != _version:
+        _role_urls.clear()
+        _version = version
+
+
+def _compile(role_id):
+    """把角色的权限id字符串编译为路由集合"""
+    role = Role.query.get(role_id)
+    if role is None or not role.auths:
+        return frozenset()
+    auth_ids = [int(item) for item in role.auths.split(',')]
+    return frozenset(url for url, in db.session.query(Auth.url).filter(Auth.id.in_(auth_ids)))
+
+
+def role_urls(role_id):
+    """返回角色允许访问的路由集合，本进程缓存，只有在缓存失效后才查询数据库"""
+    _check_version()
+    urls = _role_urls.get(role_id)
+    if urls is None:
+        urls = _role_urls[role_id] = _compile(role_id)
+    return urls
+
+
+def has_permission(role_id, rule):
+    """判断角色是否有访问该路由的权限"""
+    return str(rule) in role_urls(role_id)
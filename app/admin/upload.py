@@ -0,0 +1,138 @@
+import hashlib
+import os
+import time
+import uuid
+from redis.exceptions import LockError
+from flask import current_app
+from app import rd
+
+# 上传状态，hash结构：原文件名、文件大小、整个文件的sha256(可选)
+UPLOAD_KEY = "upload:{}"
+# 同一个上传同时只能写入一个分片
+UPLOAD_LOCK_KEY = "upload:{}:lock"
+# 从请求中读取数据的缓冲大小
+BUFFER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """上传出错，code为返回给客户端的状态码"""
+
+    def __init__(self, message, code=400):
+        super(UploadError, self).__init__(message)
+        self.message = message
+        self.code = code
+
+
+def _part_path(upload_id):
+    """未完成的文件保存在上传目录下的临时目录中，和上传目录在同一个文件系统，完成后直接改名"""
+    return os.path.join(current_app.config['UPLOAD_TMP_DIR'], upload_id + '.part')
+
+
+def create(filename, size, checksum=None):
+    """创建一个上传，返回上传id，checksum为整个文件的sha256，完成时校验"""
+    if size <= 0 or size > current_app.config['UPLOAD_MAX_SIZE']:
+        raise UploadError('文件大小不正确')
+    if not os.path.exists(current_app.config['UPLOAD_TMP_DIR']):
+        os.makedirs(current_app.config['UPLOAD_TMP_DIR'])
+    upload_id = uuid.uuid4().hex
+    open(_part_path(upload_id), 'wb').close()
+    key = UPLOAD_KEY.format(upload_id)
+    pipe = rd.pipeline()
+    pipe.hmset(key, {'filename': filename, 'size': size, 'checksum': checksum or ''})
+    pipe.expire(key, current_app.config['UPLOAD_EXPIRE'])
+    pipe.execute()
+    return upload_id
+
+
+def get(upload_id):
+    """返回上传状态{'filename', 'size', 'offset', 'checksum'}，上传不存在或已过期时返回None"""
+    data = rd.hgetall(UPLOAD_KEY.format(upload_id))
+    if not data or not os.path.exists(_part_path(upload_id)):
+        return None
+    return {
+        'filename': data[b'filename'].decode(),
+        'size': int(data[b'size']),
+        'offset': os.path.getsize(_part_path(upload_id)),
+        'checksum': data[b'checksum'].decode(),
+    }
+
+
+def write_chunk(upload_id, offset, stream, length, checksum=None):
+    """从offset开始把stream中的length字节直接写入文件，返回写入后的偏移
+    offset必须等于已经上传的大小，断开后客户端先查询偏移再续传
+    checksum为这个分片的sha256，不一致时丢弃这个分片
+    """
+    lock = rd.lock(UPLOAD_LOCK_KEY.format(upload_id), timeout=600)
+    if not lock.acquire(blocking=False):
+        raise UploadError('分片正在上传', 409)
+    try:
+        # 加锁之后再检查偏移，同时上传相同偏移的分片时只有一个能写入
+        state = get(upload_id)
+        if state is None:
+            raise UploadError('上传不存在或已过期', 404)
+        if offset != state['offset']:
+            raise UploadError('偏移不正确，当前偏移为{}'.format(state['offset']), 409)
+        if length <= 0 or offset + length > state['size']:
+            raise UploadError('分片大小不正确')
+        sha256 = hashlib.sha256()
+        written = 0
+        with open(_part_path(upload_id), 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                data = stream.read(min(BUFFER_SIZE, length - written))
+                if not data:
+                    break
+                f.write(data)
+                sha256.update(data)
+                written += len(data)
+            if written != length or (checksum and sha256.hexdigest() != checksum.lower()):
+                f.truncate(offset)  # 分片不完整或者校验失败，丢弃这个分片
+                raise UploadError('分片数据不完整或校验失败，请重新上传', 422)
+        rd.expire(UPLOAD_KEY.format(upload_id), current_app.config['UPLOAD_EXPIRE'])
+        return offset + written
+    finally:
+        try:
+            lock.release()  # 只释放自己的锁，锁已经过期时不会删除其他请求的锁
+        except LockError:
+            pass
+
+
+def finish(upload_id, path):
+    """完成上传：校验文件大小和sha256，然后把文件移动到path"""
+    state = get(upload_id)
+    if state is None:
+        raise UploadError('上传不存在或已过期', 404)
+    if state['offset'] != state['size']:
+        raise UploadError('文件还没有上传完成', 409)
+    if state['checksum']:
+        sha256 = hashlib.sha256()
+        with open(_part_path(upload_id), 'rb') as f:
+            for data in iter(lambda: f.read(BUFFER_SIZE), b''):
+                sha256.update(data)
+        if sha256.hexdigest() != state['checksum'].lower():
+            abort_upload(upload_id)
+            raise UploadError('文件校验失败，请重新上传', 422)
+    os.replace(_part_path(upload_id), path)
+    rd.delete(UPLOAD_KEY.format(upload_id))
+
+
+def abort_upload(upload_id):
+    """取消上传，删除未完成的文件"""
+    if os.path.exists(_part_path(upload_id)):
+        os.remove(_part_path(upload_id))
+    rd.delete(UPLOAD_KEY.format(upload_id))
+
+
+def clean_expired():
+    """删除已经过期的未完成文件，返回删除的数量"""
+    tmp_dir = current_app.config['UPLOAD_TMP_DIR']
+    if not os.path.exists(tmp_dir):
+        return 0
+    num = 0
+    deadline = time.time() - current_app.config['UPLOAD_EXPIRE']
+    for name in os.listdir(tmp_dir):
+        path = os.path.join(tmp_dir, name)
+        if name.endswith('.part') and os.path.getmtime(path) < deadline:
+            abort_upload(name[:-len('.part')])
+            num += 1
+    return num
@@ -1,12 +1,12 @@
 from . import admin
-from flask import render_template, redirect, url_for, flash, session, request, abort
+from flask import render_template, redirect, url_for, flash, session, request, abort, current_app
 from app.admin.forms import LoginFrom, TagForm, MovieForm, PreviewForm, PwdForm, AuthForm, RoleForm, AdminForm
 from app.models import Admin, Tag, Movie, Preview, User, Comment, MovieCollect, Auth, Role, OperateLog, UserLog, AdminLog
 from functools import wraps
-from app import db, app
+from app import db, cache, catalog, conditional, counter, jobs, logpartition, logwriter, mp4, search, storage, thumbnail
+from app.pagination import cursor_paginate
+from app.admin import permission, upload
 from werkzeug.utils import secure_filename
-import os
-import uuid  # 生成唯一字符串
 import datetime  # 生成时间
 
 
@@ -35,34 +35,49 @@ def admin_login_require(func):
 def permission_control(func):
     @wraps(func)
     def decorated_function(*args, **kwargs):
-        login_admin = Admin.query.join(
-            Role
-        ) .filter(
-            Role.id == Admin.role_id,
-            Admin.name == session['login_admin']
-        ).first()
+        if 'admin_role_id' not in session:
+            # 登录时已经把角色和是否超级管理员保存在session中，旧的session才需要查询一次
+            login_admin = Admin.query.filter_by(name=session['login_admin']).first_or_404()
+            session['admin_role_id'] = login_admin.role_id
+            session['admin_is_super'] = login_admin.is_super
 
-        all_auth = Auth.query.all()  # 数据库所有权限
-
-        auths = login_admin.role.auths
-        auths = list(map(lambda item: int(item), auths.split(',')))  # 用户权限id列表
-        urls = [auth.url for auth in all_auth for admin_auth_id in auths if admin_auth_id == auth.id]
-
-        # print(urls)
         rule = request.url_rule
-        # print(rule)  # 需要转为str判断是否在list中
-        if str(rule) not in urls and login_admin.is_super != 0:  # 权限不存在，且不是超级管理员
-            abort(401)
+        # 角色的权限编译为路由集合并缓存在本进程中，判断权限不需要查询数据库
+        if session['admin_is_super'] != 0 and not permission.has_permission(session['admin_role_id'], rule):
+            abort(401)  # 权限不存在，且不是超级管理员
         return func(*args, **kwargs)
     return decorated_function
 
 
-# 修改文件名称
-def change_filename(filename):
-    fileinfo = os.path.splitext(filename)  # 分离包含路径的文件名与包含点号的扩展名
-    filename = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4().hex + fileinfo[-1])
-    print('函数中修改后的文件名：', filename)
-    return filename
+# 保存电影文件
+def save_movie_file(form):
+    """分片上传时完成上传，否则保存表单中上传的文件，返回按内容保存的文件名，出错时返回None"""
+    if form.upload_id.data:
+        state = upload.get(form.upload_id.data)
+        if state is None:
+            flash('电影文件上传已过期，请重新上传', category='err')
+            return None
+        tmp_path = storage.tmp_path()
+        try:
+            upload.finish(form.upload_id.data, tmp_path)
+        except upload.UploadError as e:
+            flash(e.message, category='err')
+            return None
+        # 上传时提供了sha256的文件已经校验过，不需要重新计算
+        url, created = storage.save_file(tmp_path, secure_filename(state['filename']), state['checksum'])
+    else:
+        url, created = storage.save(form.url.data)
+    if created:
+        mp4.process.delay(storage.path(url))  # 后台把moov移动到文件开头并生成关键帧索引
+    return url
+
+
+# 删除电影文件
+@jobs.task
+def release_movie_file(url):
+    """没有其他电影使用这个文件时连同关键帧索引一起删除"""
+    if storage.release(url):
+        mp4.remove_index(storage.path(url))
 
 
 @admin.route("/")
@@ -89,13 +104,11 @@ def login():
         session['login_admin'] = data['account']
         # 操作日志
         session['admin_id'] = login_admin.id
-        # 管理员登录日志
-        admin_log = AdminLog(
-            admin_id=login_admin.id,
-            ip=request.remote_addr
-        )
-        db.session.add(admin_log)
-        db.session.commit()
+        # 权限控制
+        session['admin_role_id'] = login_admin.role_id
+        session['admin_is_super'] = login_admin.is_super
+        # 管理员登录日志，先保存在redis中，定时批量写入数据库
+        logwriter.write(AdminLog, admin_id=login_admin.id, ip=request.remote_addr)
         return redirect(request.args.get('next') or url_for('admin.index'))
     return render_template('admin/login.html', form=form)
 
@@ -106,6 +119,8 @@ def login():
 def logout():
     session.pop('login_admin', None)  # 删除session中的登录账号
     session.pop('admin_id', None)
+    session.pop('admin_role_id', None)
+    session.pop('admin_is_super', None)
     return redirect(url_for("admin.login"))
 
 
@@ -144,16 +159,13 @@ def tag_add():
         )
         db.session.add(tag)
         db.session.commit()
+        catalog.tags.invalidate()  # 标签缓存失效
+        conditional.touch('tag')
+        # 操作日志，批量写入数据库
+        logwriter.write(OperateLog, admin_id=session['admin_id'], ip=request.remote_addr,
+                        reason="添加标签{}".format(data['name']))
         # 提交完成后也返回一条成功的消息
         flash('标签添加成功！', category='ok')
-        # 日志
-        operatelog = OperateLog(
-            admin_id=session['admin_id'],
-            ip=request.remote_addr,
-            reason="添加标签{}".format(data['name'])
-        )
-        db.session.add(operatelog)
-        db.session.commit()
         return redirect(url_for('admin.tag_add'))
     return render_template('admin/tag_add.html', form=form)
 
@@ -166,7 +178,7 @@ def tag_list(page=None):
     if page is None:
         page = 1
     # 设置per_page每页显示多少个数据
-    page_tags = Tag.query.order_by(Tag.add_time.desc()).paginate(page=page, per_page=10)
+    page_tags = cursor_paginate(Tag.query, Tag, page=page, per_page=10, with_count=True)
     return render_template('admin/tag_list.html', page_tags=page_tags)
 
 
@@ -177,8 +189,13 @@ def tag_list(page=None):
 def tag_delete(delete_id=None):
     if delete_id:
         tag = Tag.query.filter_by(id=delete_id).first_or_404()
+        movie_ids = [movie_id for movie_id, in db.session.query(Movie.id).filter_by(tag_id=tag.id)]
         db.session.delete(tag)
         db.session.commit()
+        cache.invalidate_index(tag.id)  # 首页缓存失效
+        cache.invalidate_movie_detail(*movie_ids)  # 这些电影没有标签了，详情缓存失效
+        conditional.touch('tag', 'movie')
+        catalog.tags.invalidate()  # 标签缓存失效
         # 删除后闪现消息
         flash('删除标签成功！', category='ok')
     return redirect(url_for('admin.tag_list', page=1))
@@ -200,6 +217,10 @@ def tag_update(update_id=None):
         # 如果标签不存在，就进行修改
         tag.name = data['name']
         db.session.commit()
+        catalog.tags.invalidate()  # 标签缓存失效
+        # 电影详情中包括标签名称，这个标签下的电影详情缓存都失效
+        cache.invalidate_movie_detail(*[movie_id for movie_id, in db.session.query(Movie.id).filter_by(tag_id=tag.id)])
+        conditional.touch('tag')
         # 提交完成后也返回一条成功的消息
         flash('标签修改成功！', category='ok')
         return redirect(url_for('admin.tag_update', update_id=update_id))
@@ -212,6 +233,8 @@ def tag_update(update_id=None):
 @permission_control
 def movie_add():
     form = MovieForm()
+    if form.upload_id.data:
+        form.url.validators = []  # 电影文件已经通过分片上传，表单中不需要再上传
     if form.validate_on_submit():
         data = form.data
 
@@ -220,21 +243,13 @@ def movie_add():
             flash('电影片名已存在，请检查', category='err')
             return redirect(url_for('admin.movie_add'))
 
-        # 获取上传文件的名称
-        file_url = secure_filename(form.url.data.filename)
-        file_logo = secure_filename(form.logo.data.filename)
-        # 文件保存路径操作
-        file_save_path = app.config['UP_DIR']  # 文件上传保存路径
-        if not os.path.exists(file_save_path):
-            os.makedirs(file_save_path)  # 如果文件保存路径不存在，则创建一个多级目录
-            import stat
-            os.chmod(file_save_path, stat.S_IRWXU)  # 授予可读写权限
-        # 对上传的文件进行重命名
-        url = change_filename(file_url)
-        logo = change_filename(file_logo)
-        # 保存文件，需要给文件的保存路径+文件名
-        form.url.data.save(file_save_path + url)
-        form.logo.data.save(file_save_path + logo)
+        # 保存文件，按照文件内容的hash保存，相同的文件只保存一份
+        url = save_movie_file(form)
+        if url is None:
+            return redirect(url_for('admin.movie_add'))
+        logo, created = storage.save(form.logo.data)
+        if created:
+            thumbnail.submit(logo)  # 后台生成缩略图
 
         movie = Movie(
             title=data['title'],
@@ -251,6 +266,10 @@ def movie_add():
         )
         db.session.add(movie)
         db.session.commit()
+        cache.invalidate_index(movie.tag_id)  # 首页缓存失效
+        cache.set_movie_detail(movie)  # 写入播放页的详情缓存
+        conditional.touch('movie')
+        search.index_movie(movie)  # 建立搜索索引
         flash('添加电影成功', 'ok')
         return redirect(url_for('admin.movie_add'))
     return render_template('admin/movie_add.html', form=form)
@@ -265,12 +284,11 @@ def movie_list(page=None):
         page = 1
     # 查询的时候关联标签Tag进行查询：使用join(Tag)
     # 单表过滤使用filter_by，多表关联使用filter，将Tag.id与Movie的tag_id进行关联
-    page_movies = Movie.query.join(Tag).filter(
+    page_movies = cursor_paginate(Movie.query.join(Tag).filter(
         Tag.id == Movie.tag_id
-    ).order_by(
-        Movie.add_time.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template('admin/movie_list.html', page_movies=page_movies)
+    ), Movie, page=page, per_page=10)
+    play_nums = counter.play_nums(page_movies.items)  # 播放量加上还未写入数据库的部分
+    return render_template('admin/movie_list.html', page_movies=page_movies, play_nums=play_nums)
 
 
 # 删除电影
@@ -281,17 +299,16 @@ def movie_delete(delete_id=None):
     if delete_id:
         movie = Movie.query.filter_by(id=delete_id).first_or_404()
         print(movie.logo)
-        # 删除电影同时要从磁盘中删除电影的文件和封面文件
-        file_save_path = app.config['UP_DIR']  # 文件上传保存路径
-        # 如果存在将进行删除，不判断，如果文件不存在删除会报错
-        if os.path.exists(os.path.join(file_save_path, movie.url)):
-            os.remove(os.path.join(file_save_path, movie.url))
-        if os.path.exists(os.path.join(file_save_path, movie.logo)):
-            os.remove(os.path.join(file_save_path, movie.logo))
-
         # 删除数据库，提交修改，注意后面要把与电影有关的评论都要删除
         db.session.delete(movie)
         db.session.commit()
+        # 提交后在后台删除电影的文件和封面文件，其他地方还在使用的文件只减少引用计数
+        release_movie_file.delay(movie.url)
+        storage.release.delay(movie.logo)
+        cache.invalidate_index(movie.tag_id)  # 首页缓存失效
+        cache.invalidate_movie_detail(delete_id)
+        conditional.touch('movie')
+        search.remove_movie(delete_id)  # 移除搜索索引
         # 删除后闪现消息
         flash('删除电影成功！', category='ok')
     return redirect(url_for('admin.movie_list', page=1))
@@ -335,6 +352,7 @@ def movie_update(update_id=None):
         if Movie.query.filter_by(title=data['title']).count() == 1 and movie.title != data['title']:
             flash('电影片名已存在，请检查', category='err')
             return redirect(url_for('admin.movie_update', update_id=update_id))
+        old_tag_id = movie.tag_id  # 修改前的标签，首页缓存失效时需要用到
         # 以下和直接修改的数据
         movie.title = data['title']
         movie.info = data['info']
@@ -344,41 +362,107 @@ def movie_update(update_id=None):
         movie.release_time = data['release_time']
         movie.length = data['length']
 
-        # 文件保存路径操作
-        file_save_path = app.config['UP_DIR']  # 文件上传保存路径
-        if not os.path.exists(file_save_path):
-            os.makedirs(file_save_path)  # 如果文件保存路径不存在，则创建一个多级目录
-            import stat
-            os.chmod(file_save_path, stat.S_IRWXU)  # 授予可读写权限
-
         print(form.url.data, type(form.url.data))
         # <FileStorage: 'ssh.jpg' ('image/jpeg')> <class 'werkzeug.datastructures.FileStorage'>
-        # 处理电影文件逻辑：先从磁盘中删除旧文件，然后保存新文件
-        if form.url.data:  # 上传文件不为空，才进行保存
-            # 删除以前的文件
-            if os.path.exists(os.path.join(file_save_path, movie.url)):
-                os.remove(os.path.join(file_save_path, movie.url))
-            # 获取上传文件的名称
-            file_url = secure_filename(form.url.data.filename)
-            # 对上传的文件进行重命名
-            movie.url = change_filename(file_url)
-            # 保存文件，需要给文件的保存路径+文件名
-            form.url.data.save(file_save_path + movie.url)
+        # 处理电影文件逻辑：先保存新文件，提交后在后台删除旧文件
+        old_url, old_logo = movie.url, movie.logo
+        if form.url.data or form.upload_id.data:  # 上传文件不为空，才进行保存
+            url = save_movie_file(form)
+            if url is None:
+                return redirect(url_for('admin.movie_update', update_id=update_id))
+            movie.url = url
 
         # 处理封面图
         if form.logo.data:
-            if os.path.exists(os.path.join(file_save_path, movie.logo)):
-                os.remove(os.path.join(file_save_path, movie.logo))
-            file_logo = secure_filename(form.logo.data.filename)
-            movie.logo = change_filename(file_logo)
-            form.logo.data.save(file_save_path + movie.logo)
+            movie.logo, created = storage.save(form.logo.data)
+            if created:
+                thumbnail.submit(movie.logo)
         db.session.merge(movie)  # 调用merge方法，此时Movie实体状态并没有被持久化，但是数据库中的记录被更新了（暂时不明白）
         db.session.commit()
+        # 每次保存都会增加引用计数，上传的文件和原来的相同时也要释放一次原来的文件，文件不会被删除
+        if (form.url.data or form.upload_id.data) and old_url:
+            release_movie_file.delay(old_url)
+        if form.logo.data and old_logo:
+            storage.release.delay(old_logo)
+        cache.invalidate_index(old_tag_id, movie.tag_id)  # 首页缓存失效
+        cache.set_movie_detail(movie)  # 用修改后的电影更新播放页的详情缓存
+        conditional.touch('movie')
+        search.index_movie(movie)  # 更新搜索索引
         flash('更新电影成功', 'ok')
         return redirect(url_for('admin.movie_update', update_id=update_id))
     return render_template('admin/movie_update.html', form=form, movie=movie)
 
 
+# 创建分片上传
+@admin.route("/upload/", methods=['POST'])
+@admin_login_require
+@permission_control
+def upload_create():
+    """请求体为json：filename文件名，size文件大小，checksum整个文件的sha256(可选)"""
+    import json
+    from wtforms.validators import ValidationError
+    try:
+        check_upload_csrf()
+        data = json.loads(request.get_data())
+        upload_id = upload.create(data['filename'], int(data['size']), data.get('checksum'))
+    except ValidationError:
+        return upload_response({'msg': 'CSRF验证失败'}, 400)
+    except (ValueError, KeyError, TypeError):
+        return upload_response({'msg': '参数不正确'}, 400)
+    except upload.UploadError as e:
+        return upload_response({'msg': e.message}, e.code)
+    return upload_response({
+        'upload_id': upload_id,
+        'offset': 0,
+        'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']
+    }, 201)
+
+
+# 查询上传进度和上传分片
+@admin.route("/upload/<upload_id>/", methods=['GET', 'PUT'])
+@admin_login_require
+@permission_control
+def upload_chunk(upload_id=None):
+    """GET返回已经上传的偏移，用于断点续传
+    PUT上传一个分片，请求头Upload-Offset为分片的起始偏移，Upload-Checksum为分片的sha256(可选)，请求体为分片数据
+    """
+    if request.method == 'GET':
+        state = upload.get(upload_id)
+        if state is None:
+            return upload_response({'msg': '上传不存在或已过期'}, 404)
+        return upload_response({'upload_id': upload_id, 'offset': state['offset'], 'size': state['size']})
+
+    from wtforms.validators import ValidationError
+    try:
+        check_upload_csrf()
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValidationError:
+        return upload_response({'msg': 'CSRF验证失败'}, 400)
+    except ValueError:
+        return upload_response({'msg': '缺少Upload-Offset'}, 400)
+    try:
+        # 直接从请求流中读取写入文件，不经过Werkzeug的表单解析和临时文件
+        offset = upload.write_chunk(upload_id, offset, request.stream, request.content_length or 0,
+                                    request.headers.get('Upload-Checksum'))
+    except upload.UploadError as e:
+        return upload_response({'msg': e.message}, e.code)
+    return upload_response({'upload_id': upload_id, 'offset': offset})
+
+
+# 分片上传的请求不是表单提交，从请求头X-CSRFToken中验证CSRF
+def check_upload_csrf():
+    from flask_wtf.csrf import validate_csrf
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        validate_csrf(request.headers.get('X-CSRFToken'))
+
+
+# 分片上传的json响应
+def upload_response(data, code=200):
+    import json
+    from flask import Response
+    return Response(json.dumps(data), status=code, mimetype='application/json')
+
+
 # 添加预览
 @admin.route("/preview/add/", methods=['GET', 'POST'])
 @admin_login_require
@@ -391,14 +475,9 @@ def preview_add():
             flash('预告标题已存在，请检查！', category='err')
             return redirect(url_for('admin.preview_add'))
 
-        file_logo = secure_filename(form.logo.data.filename)  # 获取上传文件名字
-        file_save_path = app.config['UP_DIR']  # 文件上传保存路径
-        if not os.path.exists(file_save_path):
-            os.makedirs(file_save_path)  # 如果文件保存路径不存在，则创建一个多级目录
-            import stat
-            os.chmod(file_save_path, stat.S_IRWXU)  # 授予可读写权限
-        logo = change_filename(file_logo)  # 文件重命名
-        form.logo.data.save(file_save_path + logo)  # 保存文件到磁盘中
+        logo, created = storage.save(form.logo.data)  # 按照文件内容保存到磁盘中
+        if created:
+            thumbnail.submit(logo)  # 后台生成缩略图
 
         preview = Preview(
             title=data['title'],
@@ -406,6 +485,7 @@ def preview_add():
         )
         db.session.add(preview)
         db.session.commit()
+        conditional.touch('preview')
         flash('添加预告成功', 'ok')
         return redirect(url_for('admin.preview_add'))
 
@@ -417,7 +497,7 @@ def preview_add():
 @admin_login_require
 @permission_control
 def preview_list(page=None):
-    page_previews = Preview.query.paginate(page=page, per_page=10)
+    page_previews = cursor_paginate(Preview.query, Preview, page=page, per_page=10, with_count=True)
     return render_template('admin/preview_list.html', page_previews=page_previews)
 
 
@@ -428,15 +508,12 @@ def preview_list(page=None):
 def preview_delete(delete_id=None):
     if delete_id:
         preview = Preview.query.filter_by(id=delete_id).first_or_404()
-        # 删除同时要从磁盘中删除封面文件
-        file_save_path = app.config['UP_DIR']  # 文件上传保存路径
-        # 如果存在将进行删除，不判断，如果文件不存在删除会报错
-        if os.path.exists(os.path.join(file_save_path, preview.logo)):
-            os.remove(os.path.join(file_save_path, preview.logo))
-
         # 删除数据库，提交修改，注意后面要把与电影有关的评论都要删除
         db.session.delete(preview)
         db.session.commit()
+        conditional.touch('preview')
+        # 提交后在后台删除封面文件
+        storage.release.delay(preview.logo)
         # 删除后闪现消息
         flash('删除预告成功！', category='ok')
     return redirect(url_for('admin.preview_list', page=1))
@@ -468,20 +545,16 @@ def preview_update(update_id=None):
         # <FileStorage: 'ssh.jpg' ('image/jpeg')> <class 'werkzeug.datastructures.FileStorage'>
         # 上面两种方式结果一样
 
-        # 文件保存路径操作
-        file_save_path = app.config['UP_DIR']  # 文件上传保存路径
-        if not os.path.exists(file_save_path):
-            os.makedirs(file_save_path)  # 如果文件保存路径不存在，则创建一个多级目录
-            import stat
-            os.chmod(file_save_path, stat.S_IRWXU)  # 授予可读写权限
+        old_logo = preview.logo
         if form.logo.data:  # 当有上传新的图片
-            if os.path.exists(os.path.join(file_save_path, preview.logo)):
-                os.remove(os.path.join(file_save_path, preview.logo))  # 删除旧图片
-            file_logo_name = form.logo.data.filename
-            preview.logo = change_filename(file_logo_name)  # 得到新的文件名，保存到输入局
-            form.logo.data.save(file_save_path + preview.logo)
+            preview.logo, created = storage.save(form.logo.data)  # 得到新的文件名，保存到数据库
+            if created:
+                thumbnail.submit(preview.logo)
         db.session.add(preview)
         db.session.commit()
+        conditional.touch('preview')
+        if form.logo.data and old_logo:
+            storage.release.delay(old_logo)  # 提交后在后台删除旧图片，上传相同的图片时只减少引用计数
         flash('预告信息修改成功！', category='ok')
         return redirect(url_for('admin.preview_update', update_id=update_id))
     return render_template('admin/preview_edit.html', form=form, preview=preview)
@@ -494,7 +567,7 @@ def preview_update(update_id=None):
 def user_list(page=None):
     if page is None:
         page = 1
-    page_users = User.query.paginate(page=page, per_page=10)
+    page_users = cursor_paginate(User.query, User, page=page, per_page=10)
     return render_template('admin/user_list.html', page_users=page_users)
 
 
@@ -513,15 +586,12 @@ def user_view(user_id=None):
 @permission_control
 def user_delete(delete_id=None):
     user = User.query.get_or_404(delete_id)
-    # 删除同时要从磁盘中删除封面文件
-    file_save_path = app.config['USER_IMAGE']  # 头像上传保存路径
-    # 如果存在将进行删除，不判断，如果文件不存在删除会报错
-    if os.path.exists(os.path.join(file_save_path, user.face)):
-        os.remove(os.path.join(file_save_path, user.face))
-
     # 删除数据库，提交修改
     db.session.delete(user)
     db.session.commit()
+    conditional.touch('comment')  # 会员的评论也被删除
+    # 提交后在后台删除头像文件
+    storage.release.delay(user.face, 'image')
     # 删除后闪现消息
     flash('删除会员成功！', category='ok')
     return redirect(url_for('admin.user_list', page=1))
@@ -534,16 +604,14 @@ def user_delete(delete_id=None):
 def comment_list(page=None):
     if page is None:
         page = 1
-    page_comments = Comment.query.join(
+    page_comments = cursor_paginate(Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Comment.movie_id,
         User.id == Comment.user_id
-    ).order_by(
-        Comment.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    ), Comment, page=page, per_page=10)
     return render_template('admin/comment_list.html', page_comments=page_comments)
 
 
@@ -555,6 +623,7 @@ def comment_delete(delete_id=None):
     comment = Comment.query.get_or_404(delete_id)
     db.session.delete(comment)
     db.session.commit()
+    conditional.touch('comment')
     flash('删除评论成功！', category='ok')
     return redirect(url_for('admin.comment_list', page=1))
 
@@ -566,16 +635,14 @@ def comment_delete(delete_id=None):
 def collect_list(page=None):
     if page is None:
         page = 1
-    page_moviecollects = MovieCollect.query.join(
+    page_moviecollects = cursor_paginate(MovieCollect.query.join(
         Movie
     ).join(
         User
     ).filter(
-        Movie.id == Comment.movie_id,
-        User.id == Comment.user_id
-    ).order_by(
-        Comment.add_time.desc()
-    ).paginate(page=page, per_page=10)
+        Movie.id == MovieCollect.movie_id,
+        User.id == MovieCollect.user_id
+    ), MovieCollect, page=page, per_page=10)
     return render_template('admin/collect_list.html', page_moviecollects=page_moviecollects)
 
 
@@ -597,13 +664,10 @@ def collect_delete(delete_id=None):
 def logs_operate_log(page=None):
     if page is None:
         page = 1
-    page_logs_operate_log = OperateLog.query.join(
-        Admin
-    ).filter(
-        Admin.id == OperateLog.admin_id,
-    ).order_by(
-        OperateLog.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    logwriter.flush()  # 先写入还在redis中的日志
+    page_logs_operate_log = cursor_paginate(OperateLog.query.join(
+        Admin, Admin.id == OperateLog.admin_id  # 日志表没有外键，需要指定关联条件
+    ), OperateLog, page=page, per_page=10)
     return render_template('admin/logs_operate_log.html', page_logs_operate_log=page_logs_operate_log)
 
 
@@ -614,13 +678,10 @@ def logs_operate_log(page=None):
 def logs_admin_log(page=None):
     if page is None:
         page = 1
-    page_logs_admin_log = AdminLog.query.join(
-        Admin
-    ).filter(
-        Admin.id == AdminLog.admin_id,
-    ).order_by(
-        AdminLog.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    logwriter.flush()  # 先写入还在redis中的日志
+    page_logs_admin_log = cursor_paginate(AdminLog.query.join(
+        Admin, Admin.id == AdminLog.admin_id  # 日志表没有外键，需要指定关联条件
+    ), AdminLog, page=page, per_page=10)
     return render_template('admin/logs_admin_log.html', page_logs_admin_log=page_logs_admin_log)
 
 
@@ -631,16 +692,22 @@ def logs_admin_log(page=None):
 def logs_user_log(page=None):
     if page is None:
         page = 1
-    page_logs_user_log = UserLog.query.join(
-        User
-    ).filter(
-        User.id == UserLog.user_id,
-    ).order_by(
-        UserLog.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    logwriter.flush()  # 先写入还在redis中的日志
+    page_logs_user_log = cursor_paginate(UserLog.query.join(
+        User, User.id == UserLog.user_id  # 日志表没有外键，需要指定关联条件
+    ), UserLog, page=page, per_page=10)
     return render_template('admin/logs_user_log.html', page_logs_user_log=page_logs_user_log)
 
 
+# 日志统计，查询每日汇总，不扫描原始日志
+@admin.route("/logs/stats/", methods=["GET"])
+@admin_login_require
+@permission_control
+def logs_stats():
+    stats = logpartition.daily_stats(days=30)
+    return render_template('admin/logs_stats.html', stats=stats)
+
+
 # 权限添加
 @admin.route("/auth/add/", methods=['GET', 'POST'])
 @admin_login_require
@@ -658,6 +725,8 @@ def auth_add():
         )
         db.session.add(auth)
         db.session.commit()
+        permission.invalidate()  # 角色权限缓存失效
+        catalog.auths.invalidate()  # 权限缓存失效
         flash('权限地址添加成功！', category='ok')
     return render_template('admin/auth_edit.html', form=form)
 
@@ -669,7 +738,7 @@ def auth_add():
 def auth_list(page=None):
     if not page:
         page = 1
-    page_auths = Auth.query.order_by(Auth.add_time.asc()).paginate(page=page, per_page=10)
+    page_auths = cursor_paginate(Auth.query, Auth, page=page, per_page=10, desc=False, with_count=True)
     return render_template('admin/auth_list.html', page_auths=page_auths)
 
 
@@ -681,6 +750,8 @@ def auth_delete(delete_id=None):
     auth = Auth.query.get_or_404(delete_id)
     db.session.delete(auth)
     db.session.commit()
+    permission.invalidate()  # 角色权限缓存失效
+    catalog.auths.invalidate()  # 权限缓存失效
     flash('删除权限地址成功', category='ok')
     return redirect(url_for('admin.auth_list', page=1))
 
@@ -704,6 +775,8 @@ def auth_update(update_id=None):
         auth.url = data['url']
 
         db.session.commit()
+        permission.invalidate()  # 角色权限缓存失效
+        catalog.auths.invalidate()  # 权限缓存失效
         flash('权限地址修改成功！', category='ok')
     return render_template('admin/auth_edit.html', form=form)
 
@@ -723,6 +796,7 @@ def role_add():
         )
         db.session.add(role)
         db.session.commit()
+        catalog.roles.invalidate()  # 角色缓存失效
         flash('角色添加成功', category='ok')
     return render_template('admin/role_edit.html', form=form)
 
@@ -734,9 +808,7 @@ def role_add():
 def role_list(page=None):
     if not page:
         page = 1
-    page_roles = Role.query.order_by(
-        Role.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    page_roles = cursor_paginate(Role.query, Role, page=page, per_page=10, with_count=True)
     return render_template('admin/role_list.html', page_roles=page_roles)
 
 
@@ -748,6 +820,8 @@ def role_delete(delete_id=None):
     role = Role.query.get_or_404(delete_id)
     db.session.delete(role)
     db.session.commit()
+    permission.invalidate()  # 角色权限缓存失效
+    catalog.roles.invalidate()  # 角色缓存失效
     flash('角色删除成功', category='ok')
     return redirect(url_for('admin.role_list', page=1))
 
@@ -768,6 +842,8 @@ def role_update(update_id=None):
         role.auths = ','.join(map(lambda item: str(item), data['auths']))
 
         db.session.commit()
+        permission.invalidate()  # 角色权限缓存失效
+        catalog.roles.invalidate()  # 角色缓存失效
         flash('角色修改成功！', category='ok')
     return render_template('admin/role_edit.html', form=form)
 
@@ -804,11 +880,9 @@ def admin_add():
 def admin_list(page=None):
     if not page:
         page = 1
-    page_admins = Admin.query.order_by(
-        Admin.add_time.desc()
-    ).join(
+    page_admins = cursor_paginate(Admin.query.join(
         Role
     ).filter(
         Role.id == Admin.role_id  # 关联查询
-    ).paginate(page=page, per_page=10)
+    ), Admin, page=page, per_page=10, with_count=True)
     return render_template('admin/admin_list.html', page_admins=page_admins)
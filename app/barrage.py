@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from redis import WatchError
+from flask import current_app
+from app import jobs, rd
+
+
+# 弹幕按照视频播放时间存放在有序集合中，score为弹幕的time，成员为"_id:DPlayer格式的json数组"
+def time_key(movie_id):
+    return "movie{}:barrage:time".format(movie_id)
+
+
+# 弹幕的发送顺序，用于超过保留数量时删除最早发送的弹幕
+def order_key(movie_id):
+    return "movie{}:barrage:order".format(movie_id)
+
+
+# 编码好的弹幕数组内容，GET请求不带时间区间时直接返回，发送弹幕时追加
+def body_key(movie_id):
+    return "movie{}:barrage:body".format(movie_id)
+
+
+# 编码好的弹幕数组中的弹幕数量
+def body_count_key(movie_id):
+    return "movie{}:barrage:body_count".format(movie_id)
+
+
+# 重建弹幕数组的间隔锁，弹幕数组已满时同一部电影每隔一段时间最多重建一次
+def rebuild_lock_key(movie_id):
+    return "movie{}:barrage:rebuild_lock".format(movie_id)
+
+
+# 弹幕版本号，每发送或删除弹幕加1，用作ETag
+def version_key(movie_id):
+    return "movie{}:barrage:version".format(movie_id)
+
+
+# 新弹幕的发布订阅频道，推送给正在观看的用户
+def channel_key(movie_id):
+    return "movie{}:barrage:channel".format(movie_id)
+
+
+# 所有电影的弹幕频道，每个进程只用一个订阅连接按照这个模式订阅
+CHANNEL_PATTERN = "movie*:barrage:channel"
+
+# 本进程正在推送的连接：{电影id: set(每个连接的消息队列)}，由订阅线程把新弹幕分发到队列中
+_listeners = {}
+_listeners_lock = threading.Lock()
+# 启动订阅线程的进程id，fork出的子进程需要重新启动订阅线程
+_listener_pid = None
+# 每个连接最多缓存的消息数量，浏览器接收太慢时丢弃新消息
+LISTENER_QUEUE_SIZE = 100
+
+# 订阅线程没有app上下文，使用模块的logger
+logger = logging.getLogger('app.barrage')
+
+
+# 旧版本按照发送顺序存放完整弹幕消息的列表
+def legacy_key(movie_id):
+    return "movie{}:barrage".format(movie_id)
+
+
+def _member(msg):
+    """DPlayer读取弹幕的格式为[time, type, color, author, text]，提前编码好，读取时不需要再解析json"""
+    row = [msg['time'], msg['type'], msg['color'], msg['author'], msg['text']]
+    return "{}:{}".format(msg['_id'], json.dumps(row))
+
+
+def add(movie_id, msg, publish=True):
+    """添加一条弹幕，同时追加到编码好的弹幕数组中，超过每部电影的保留数量时删除最早发送的弹幕
+    publish为True时通过redis发布订阅推送给正在观看的用户
+    """
+    member = _member(msg)
+    row = member.split(':', 1)[1]
+    with rd.pipeline() as pipe:
+        while True:
+            try:
+                # 监听弹幕数组，和重建数组同时进行时重试，保证数组和版本号一致
+                pipe.watch(body_key(movie_id), body_count_key(movie_id))
+                body_len = pipe.strlen(body_key(movie_id)) if pipe.exists(body_key(movie_id)) else None
+                body_count = int(pipe.get(body_count_key(movie_id)) or 0)
+                pipe.multi()
+                pipe.zadd(time_key(movie_id), {member: float(msg['time'])})
+                pipe.lpush(order_key(movie_id), member)
+                pipe.incr(version_key(movie_id))
+                # 已经达到返回数量上限时不再追加，继续返回已有的数组，之后在后台重建
+                full = body_len is not None and body_count >= current_app.config['BARRAGE_MAX_FETCH']
+                if body_len is not None and not full:
+                    pipe.append(body_key(movie_id), (', ' if body_len else '') + row)
+                    pipe.incr(body_count_key(movie_id))
+                if publish:
+                    pipe.publish(channel_key(movie_id), row)
+                pipe.execute()
+                break
+            except WatchError:
+                continue
+    if full:
+        _schedule_rebuild(movie_id)
+    _trim(movie_id)
+
+
+def _trim(movie_id):
+    """按照发送顺序只保留最新的BARRAGE_MAX_PER_MOVIE条弹幕"""
+    max_num = current_app.config['BARRAGE_MAX_PER_MOVIE']
+    if rd.llen(order_key(movie_id)) <= max_num:
+        return
+    pipe = rd.pipeline()
+    pipe.lrange(order_key(movie_id), max_num, -1)
+    pipe.ltrim(order_key(movie_id), 0, max_num - 1)
+    expired = pipe.execute()[0]
+    if expired:
+        pipe = rd.pipeline()
+        pipe.zrem(time_key(movie_id), *expired)
+        pipe.incr(version_key(movie_id))
+        pipe.execute()
+        _schedule_rebuild(movie_id)  # 数组中可能还有删除的弹幕，继续返回，之后在后台重建
+
+
+def fetch(movie_id, start='-inf', end='+inf', max_num=None):
+    """获取视频时间在[start, end]区间内的弹幕，返回编码好的json数组字符串列表，最多返回max_num条"""
+    max_num = min(max_num or current_app.config['BARRAGE_MAX_FETCH'], current_app.config['BARRAGE_MAX_FETCH'])
+    members = rd.zrangebyscore(time_key(movie_id), start, end, start=0, num=max_num)
+    if not members and _migrate_legacy(movie_id):
+        members = rd.zrangebyscore(time_key(movie_id), start, end, start=0, num=max_num)
+    return [member.decode().split(':', 1)[1] for member in members]
+
+
+def etag(movie_id, version=None):
+    """根据弹幕版本号生成ETag，弹幕没有变化时ETag不变"""
+    if version is None:
+        version = rd.get(version_key(movie_id))
+    return "barrage-{}-{}".format(movie_id, int(version or 0))
+
+
+def payload(movie_id):
+    """返回(ETag, 编码好的弹幕数组内容)，数组不存在时从有序集合中重建"""
+    pipe = rd.pipeline()
+    pipe.get(version_key(movie_id))
+    pipe.get(body_key(movie_id))
+    version, body = pipe.execute()
+    if body is None:
+        _, version, body = _rebuild(movie_id)
+    return etag(movie_id, version), body
+
+
+def _rebuild(movie_id, bump=False):
+    """从有序集合中重建编码好的弹幕数组，重建期间有新弹幕时不保存，返回(是否保存, 版本号, 数组内容)
+    bump为True时版本号加1，替换已有的数组后浏览器缓存的旧数组的ETag失效
+    """
+    with rd.pipeline() as pipe:
+        pipe.watch(version_key(movie_id))
+        version = int(pipe.get(version_key(movie_id)) or 0)
+        rows = fetch(movie_id)
+        body = ', '.join(rows).encode()
+        pipe.multi()
+        pipe.set(body_key(movie_id), body)
+        pipe.set(body_count_key(movie_id), len(rows))
+        if bump:
+            pipe.incr(version_key(movie_id))
+            version += 1
+        try:
+            pipe.execute()
+        except WatchError:
+            return False, version, body
+    return True, version, body
+
+
+def _schedule_rebuild(movie_id):
+    """弹幕数组已满或者删除了弹幕时，每隔BARRAGE_REBUILD_INTERVAL秒最多在后台重建一次"""
+    if rd.set(rebuild_lock_key(movie_id), 1, nx=True, ex=current_app.config['BARRAGE_REBUILD_INTERVAL']):
+        rebuild.delay(movie_id)
+
+
+@jobs.task
+def rebuild(movie_id, attempts=3):
+    """后台重建弹幕数组，和发送弹幕同时进行时重试，返回是否重建成功"""
+    for i in range(attempts):
+        if _rebuild(movie_id, bump=True)[0]:
+            return True
+    return False
+
+
+def _migrate_legacy(movie_id):
+    """将旧版本列表中的弹幕导入到有序集合中，只在没有新格式弹幕时执行一次"""
+    if rd.exists(time_key(movie_id)) or not rd.exists(legacy_key(movie_id)):
+        return False
+    msgs = [json.loads(msg) for msg in rd.lrange(legacy_key(movie_id), 0, -1)]
+    for msg in reversed(msgs):  # 列表中最新的在最前面，按照发送顺序导入
+        add(movie_id, msg, publish=False)
+    rd.delete(legacy_key(movie_id))
+    return True
+
+
+def _dispatch():
+    """订阅线程：按照模式订阅所有电影的弹幕频道，把新弹幕放入正在观看这部电影的连接的队列，连接断开时重新订阅"""
+    while True:
+        try:
+            pubsub = rd.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(CHANNEL_PATTERN)
+            for message in pubsub.listen():
+                try:
+                    _fan_out(message)
+                except Exception:
+                    logger.exception('分发弹幕消息失败：%r', message)  # 只跳过这条消息，不影响订阅
+        except Exception:
+            logger.exception('弹幕订阅连接断开，1秒后重新订阅')
+            time.sleep(1)
+
+
+def _fan_out(message):
+    """把一条新弹幕放入正在观看这部电影的连接的队列"""
+    channel = message['channel'].decode()
+    movie_id = int(channel[len('movie'):channel.index(':')])
+    row = message['data'].decode()
+    with _listeners_lock:
+        listeners = list(_listeners.get(movie_id, ()))
+    for listener in listeners:
+        try:
+            listener.put_nowait(row)
+        except queue.Full:
+            pass
+
+
+def _ensure_dispatcher():
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listeners_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        _listeners.clear()
+    threading.Thread(target=_dispatch, name='barrage-dispatcher', daemon=True).start()
+
+
+def subscribe(movie_id):
+    """返回接收这部电影新弹幕的队列，本进程的推送连接达到BARRAGE_STREAM_MAX_CONNECTIONS时返回None"""
+    _ensure_dispatcher()
+    with _listeners_lock:
+        if sum(len(listeners) for listeners in _listeners.values()) >= \
+                current_app.config['BARRAGE_STREAM_MAX_CONNECTIONS']:
+            return None
+        listener = queue.Queue(LISTENER_QUEUE_SIZE)
+        _listeners.setdefault(movie_id, set()).add(listener)
+    return listener
+
+
+def unsubscribe(movie_id, listener):
+    with _listeners_lock:
+        listeners = _listeners.get(movie_id)
+        if listeners is not None:
+            listeners.discard(listener)
+            if not listeners:
+                del _listeners[movie_id]
+
+
+def stream(movie_id, listener):
+    """按照Server-Sent Events格式生成listener收到的新弹幕，空闲时定时发送心跳
+    连接超过BARRAGE_STREAM_TIMEOUT秒后关闭，浏览器的EventSource会自动重连
+    """
+    try:
+        yield "retry: 3000\n\n"  # 断开后3秒重连
+        now = time.time()
+        deadline = now + current_app.config['BARRAGE_STREAM_TIMEOUT']
+        last_send = now
+        while now < deadline:
+            try:
+                row = listener.get(timeout=1.0)
+            except queue.Empty:
+                row = None
+            now = time.time()
+            if row is not None:
+                yield "data: {}\n\n".format(row)
+                last_send = now
+            elif now - last_send >= current_app.config['BARRAGE_STREAM_HEARTBEAT']:
+                yield ": ping\n\n"
+                last_send = now
+    finally:
+        unsubscribe(movie_id, listener)
@@ -0,0 +1,258 @@
+import json
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from flask import current_app
+from app import db
+from app.models import Tag, Movie, User, Comment, MovieCollect, UserLog, AdminLog, OperateLog, Admin
+
+# 生成测试数据和压测，用于在接近线上的数据量下比较优化前后的吞吐量和延迟
+
+# 生成片名和评论用的常用字，片名由这些字随机组成，搜索时可以搜到多部电影
+WORDS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严龙飞"
+# 压测的场景：首页筛选、搜索、播放页、弹幕读取和发送、后台列表
+SCENARIOS = ['index', 'search', 'play', 'tm_get', 'tm_post', 'admin_movie_list', 'admin_comment_list',
+             'admin_user_list', 'admin_user_log']
+
+
+def _title(rnd, num):
+    return ''.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 6))) + str(num)
+
+
+def _insert(table, rows):
+    """多行INSERT批量写入"""
+    if rows:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+
+
+def _bulk(table, total, make_row, batch=5000):
+    """分批生成total行数据并写入，返回写入的行数"""
+    rows = []
+    for i in range(total):
+        rows.append(make_row(i))
+        if len(rows) >= batch:
+            _insert(table, rows)
+            rows = []
+    _insert(table, rows)
+    return total
+
+
+def _max_id(model):
+    return db.session.query(func.max(model.id)).scalar() or 0
+
+
+def seed(movies=10000, users=10000, comments=100000, collects=50000, logs=100000, tags=20,
+         barrage_movies=10, barrage=1000, seed_value=0, echo=print):
+    """生成测试数据：电影、会员、评论、收藏、各种日志以及热门电影的弹幕，数量都可以配置
+    在已有数据的基础上追加，会员和电影的id从当前最大id之后开始
+    """
+    from app import barrage as movie_barrage
+    rnd = random.Random(seed_value)
+    now = datetime.now()
+
+    def random_time(days=365):
+        return now - timedelta(seconds=rnd.randint(0, days * 86400))
+
+    # 标签
+    existing_tags = Tag.query.count()
+    first_tag = _max_id(Tag) + 1
+    _bulk(Tag.__table__, max(tags - existing_tags, 0), lambda i: {
+        'id': first_tag + i, 'name': '标签{}'.format(first_tag + i), 'add_time': now,
+    })
+    tag_ids = [tag_id for tag_id, in db.session.query(Tag.id)]
+    echo('标签：{}个'.format(len(tag_ids)))
+
+    # 会员
+    first_user = _max_id(User) + 1
+    _bulk(User.__table__, users, lambda i: {
+        'id': first_user + i, 'name': 'user{}'.format(first_user + i), 'pwd': 'x',
+        'email': 'user{}@example.com'.format(first_user + i), 'phone': str(13000000000 + first_user + i),
+        'info': '', 'face': None, 'add_time': random_time(), 'uuid': 'bench{}'.format(first_user + i),
+    })
+    echo('会员：{}个'.format(users))
+
+    # 电影：播放量和评论量按照长尾分布，少数电影非常热门
+    first_movie = _max_id(Movie) + 1
+
+    def make_movie(i):
+        release_time = (now - timedelta(days=rnd.randint(0, 365 * 5))).date()
+        return {
+            'id': first_movie + i, 'title': _title(rnd, first_movie + i), 'url': 'bench.mp4',
+            'info': ''.join(rnd.choice(WORDS) for _ in range(40)), 'logo': 'bench.jpg',
+            'star': rnd.randint(1, 5), 'play_num': int(rnd.paretovariate(1.2) * 100),
+            'comment_num': int(rnd.paretovariate(1.5) * 10), 'tag_id': rnd.choice(tag_ids), 'area': '中国',
+            'release_time': release_time, 'release_year': release_time.year, 'length': str(rnd.randint(80, 180)),
+            'add_time': random_time(),
+        }
+    _bulk(Movie.__table__, movies, make_movie)
+    echo('电影：{}部'.format(movies))
+
+    last_movie, last_user = first_movie + movies - 1, first_user + users - 1
+    # 评论和收藏集中在前面10%的热门电影
+    hot_movies = max(movies // 10, 1)
+
+    def random_movie():
+        if rnd.random() < 0.8:
+            return first_movie + rnd.randrange(hot_movies)
+        return rnd.randint(first_movie, last_movie)
+
+    _bulk(Comment.__table__, comments, lambda i: {
+        'content': ''.join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 60))),
+        'movie_id': random_movie(), 'user_id': rnd.randint(first_user, last_user), 'add_time': random_time(),
+    })
+    echo('评论：{}条'.format(comments))
+    _bulk(MovieCollect.__table__, collects, lambda i: {
+        'movie_id': random_movie(), 'user_id': rnd.randint(first_user, last_user), 'add_time': random_time(),
+    })
+    echo('收藏：{}条'.format(collects))
+
+    # 日志：保留时间内的会员登录日志，以及管理员的登录日志和操作日志
+    admin_ids = [admin_id for admin_id, in db.session.query(Admin.id)] or [1]
+    months = current_app.config['LOG_RETENTION_MONTHS']
+    _bulk(UserLog.__table__, logs, lambda i: {
+        'user_id': rnd.randint(first_user, last_user), 'ip': '10.0.{}.{}'.format(rnd.randrange(256), rnd.randrange(256)),
+        'add_time': random_time(months * 30),
+    })
+    _bulk(AdminLog.__table__, logs // 100, lambda i: {
+        'admin_id': rnd.choice(admin_ids), 'ip': '10.1.0.1', 'add_time': random_time(months * 30),
+    })
+    _bulk(OperateLog.__table__, logs // 10, lambda i: {
+        'admin_id': rnd.choice(admin_ids), 'ip': '10.1.0.1', 'reason': '压测操作{}'.format(i),
+        'add_time': random_time(months * 30),
+    })
+    echo('日志：{}条'.format(logs + logs // 100 + logs // 10))
+
+    # 最热门的几部电影的弹幕
+    for movie_id in range(first_movie, first_movie + min(barrage_movies, movies)):
+        for i in range(barrage):
+            movie_barrage.add(movie_id, {
+                '_id': '{}-{}'.format(movie_id, i), 'author': 'bench', 'time': rnd.uniform(0, 7200),
+                'text': _title(rnd, i), 'color': 16777215, 'type': 0, 'ip': '127.0.0.1',
+                'player': str(movie_id),
+            }, publish=False)
+    echo('弹幕：{}部电影，每部{}条'.format(min(barrage_movies, movies), barrage))
+    return first_movie, last_movie
+
+
+def _percentile(values, percent):
+    """最近秩法计算百分位数"""
+    if not values:
+        return 0
+    index = max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
+class _Client(object):
+    """压测客户端：没有base_url时直接调用wsgi应用(不经过网络)，否则发送http请求"""
+
+    def __init__(self, base_url=None, cookie=None):
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.cookie = cookie
+        self.test_client = None
+        if not self.base_url:
+            self.test_client = current_app.test_client()
+            admin = Admin.query.filter_by(is_super=0).first()
+            with self.test_client.session_transaction() as session:
+                # 超级管理员的登录状态，压测后台列表页面
+                if admin is not None:
+                    session['login_admin'] = admin.name
+                    session['admin_id'] = admin.id
+                    session['admin_role_id'] = admin.role_id
+                    session['admin_is_super'] = admin.is_super
+
+    def request(self, method, path, body=None):
+        if self.test_client is not None:
+            response = self.test_client.open(path, method=method, data=body)
+            return response.status_code
+        from urllib.request import Request, urlopen
+        from urllib.error import HTTPError
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        request = Request(self.base_url + path, data=body.encode() if body else None, headers=headers, method=method)
+        try:
+            with urlopen(request) as response:
+                response.read()
+                return response.status
+        except HTTPError as e:
+            return e.code
+
+
+def _paths(scenario, rnd, movie_ids, words):
+    """生成一次请求：(方法, 路径, 请求体)"""
+    movie_id = rnd.choice(movie_ids)
+    if scenario == 'index':
+        # 筛选后的结果可能不足一页，大部分请求访问第一页
+        return 'GET', '/index/{}/?tag_id={}&star_num={}&time_year={}&play_num={}&comment_num={}'.format(
+            rnd.choice([1, 1, 1, 2]), rnd.choice([0, 0, 1, 2, 3]), rnd.randint(0, 5),
+            rnd.choice([1, 1, 0, datetime.now().year - 1, datetime.now().year - 2]),
+            rnd.randint(0, 1), rnd.randint(0, 1)), None
+    if scenario == 'search':
+        return 'GET', '/search/1?keyword={}'.format(''.join(rnd.sample(words, 2))), None
+    if scenario == 'play':
+        return 'GET', '/play/{}/page/{}/'.format(movie_id, rnd.choice([1, 1, 1, 2, 3])), None
+    if scenario == 'tm_get':
+        return 'GET', '/tm/v3/?id={}'.format(movie_id), None
+    if scenario == 'tm_post':
+        return 'POST', '/tm/v3/', json.dumps({
+            'id': str(movie_id), 'author': 'bench', 'time': rnd.uniform(0, 7200), 'text': 'bench',
+            'color': 16777215, 'type': 0,
+        })
+    return 'GET', {
+        'admin_movie_list': '/admin/movie/list/{}/',
+        'admin_comment_list': '/admin/comment/list/{}/',
+        'admin_user_list': '/admin/user/list/{}/',
+        'admin_user_log': '/admin/logs/user_log/{}',
+    }[scenario].format(rnd.randint(1, 20)), None
+
+
+def run(scenarios=None, requests=200, concurrency=8, base_url=None, cookie=None, seed_value=0):
+    """按场景压测，返回{场景: {'requests', 'errors', 'rps', 'p50', 'p95', 'p99'}}，延迟单位为毫秒
+    每个场景分别压测requests次，concurrency个线程并发
+    """
+    rnd = random.Random(seed_value)
+    # 热门电影被访问的概率更高
+    movie_ids = [movie_id for movie_id, in db.session.query(Movie.id).order_by(Movie.play_num.desc()).limit(1000)]
+    if not movie_ids:
+        raise ValueError('没有电影数据，请先执行seed_dataset生成测试数据')
+    titles = ''.join(title for title, in db.session.query(Movie.title).limit(200))
+    words = [word for word in titles if not word.isdigit()] or list(WORDS)
+    client = _Client(base_url, cookie)
+    results = {}
+    for scenario in scenarios or SCENARIOS:
+        plan = [_paths(scenario, rnd, movie_ids, words) for _ in range(requests)]
+
+        def send(item):
+            start = time.perf_counter()
+            status = client.request(*item)
+            return (time.perf_counter() - start) * 1000, status
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(send, plan))
+        elapsed = time.perf_counter() - start
+        latencies = sorted(latency for latency, _ in samples)
+        results[scenario] = {
+            'requests': len(samples),
+            'errors': sum(1 for _, status in samples if status >= 400),
+            'rps': round(len(samples) / elapsed, 1) if elapsed else 0,
+            'p50': round(_percentile(latencies, 50), 1),
+            'p95': round(_percentile(latencies, 95), 1),
+            'p99': round(_percentile(latencies, 99), 1),
+        }
+    return results
+
+
+# 压测结果表格的格式，表头和每一行使用同一个格式，表头用英文，中文的显示宽度和字符数不一致会错位
+REPORT_FORMAT = '{:<20}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'
+REPORT_COLUMNS = ('requests', 'errors', 'rps', 'p50', 'p95', 'p99')
+
+
+def report(results):
+    """把run()的结果格式化为表格，返回每一行的字符串"""
+    lines = [REPORT_FORMAT.format('scenario', 'requests', 'errors', 'rps', 'p50(ms)', 'p95(ms)', 'p99(ms)')]
+    for scenario, result in results.items():
+        lines.append(REPORT_FORMAT.format(scenario, *[result[column] for column in REPORT_COLUMNS]))
+    return lines
@@ -0,0 +1,147 @@
+from types import SimpleNamespace
+from flask import current_app
+from app import rd, stampede
+from app.models import Movie, Tag
+
+
+# 首页筛选结果缓存的版本号，hash结构：all字段对应全部标签，其他字段为标签id
+INDEX_VERSION_KEY = "movie:index:version"
+
+
+def _index_versions(tag_id):
+    """获取首页缓存依赖的版本号，不筛选标签时只依赖all，筛选标签时同时依赖该标签的版本号"""
+    if int(tag_id) == 0:
+        version = rd.hget(INDEX_VERSION_KEY, "all")
+        return "a{}".format(int(version or 0))
+    versions = rd.hmget(INDEX_VERSION_KEY, "all", str(tag_id))
+    return "a{}t{}".format(int(versions[0] or 0), int(versions[1] or 0))
+
+
+def index_cache_key(selected, page):
+    """根据筛选条件和页码拼接首页缓存的键，键中带上版本号，版本号变化后旧键自然失效"""
+    return "movie:index:{}:tag{}:star{}:year{}:play{}:comment{}:page{}".format(
+        _index_versions(selected['tag_id']),
+        int(selected['tag_id']),
+        int(selected['star_num']),
+        int(selected['time_year']),
+        int(selected['play_num']),
+        int(selected['comment_num']),
+        int(page)
+    )
+
+
+def index_query(selected):
+    """根据首页的筛选条件生成查询"""
+    query = Movie.query
+    # 标签
+    if int(selected['tag_id']) != 0:
+        query = query.filter_by(tag_id=selected['tag_id'])
+    # 星级
+    if int(selected['star_num']) != 0:
+        query = query.filter_by(star=selected['star_num'])
+    # 时间
+    time_year = int(selected['time_year'])
+    if time_year == 0:
+        query = query.order_by(Movie.add_time.asc())  # 更早的年份
+    elif time_year == 1:
+        query = query.order_by(Movie.add_time.desc())  # 所有年份的电影
+    else:
+        query = query.filter(Movie.release_year == time_year)  # 筛选年份，使用上映年份字段才能走索引
+    # 播放量
+    if int(selected['play_num']) == 1:
+        query = query.order_by(Movie.play_num.desc())
+    else:
+        query = query.order_by(Movie.play_num.asc())
+    # 评论
+    if int(selected['comment_num']) == 1:
+        query = query.order_by(Movie.comment_num.desc())
+    else:
+        query = query.order_by(Movie.comment_num.asc())
+    return query
+
+
+def get_index_page(selected, page):
+    """返回当前页的电影id列表和筛选结果总数{"ids": [], "total": 0}，缓存中没有时查询数据库
+    缓存过期后可能在后台线程中重新查询，查询在loader中生成，使用后台线程自己的数据库会话，不能使用请求中的查询
+    """
+    selected = {key: selected[key] for key in ('tag_id', 'star_num', 'time_year', 'play_num', 'comment_num')}
+
+    def load():
+        page_movies = index_query(selected).paginate(page=page, per_page=10)
+        return {"ids": [movie.id for movie in page_movies.items], "total": page_movies.total}
+    return stampede.get(index_cache_key(selected, page), load, current_app.config['INDEX_CACHE_TIMEOUT'],
+                        name='index')
+
+
+def invalidate_index(*tag_ids):
+    """电影或标签变化时使首页缓存失效：全部标签的结果一定失效，筛选标签的结果只失效相关的标签"""
+    pipe = rd.pipeline()
+    pipe.hincrby(INDEX_VERSION_KEY, "all", 1)
+    for tag_id in set(tag_ids):
+        if tag_id:
+            pipe.hincrby(INDEX_VERSION_KEY, str(tag_id), 1)
+    pipe.execute()
+
+
+# 播放页的电影详情缓存，json结构，包括标签名称，后台修改电影时直接写入新的详情
+MOVIE_DETAIL_KEY = "movie:detail:{}"
+
+
+def _movie_detail_data(movie):
+    return {
+        'id': movie.id,
+        'title': movie.title,
+        'url': movie.url,
+        'info': movie.info,
+        'logo': movie.logo,
+        'star': movie.star,
+        'play_num': movie.play_num,
+        'comment_num': movie.comment_num,
+        'tag_id': movie.tag_id,
+        'tag': {'id': movie.tag.id, 'name': movie.tag.name},
+        'area': movie.area,
+        'release_time': movie.release_time.isoformat() if movie.release_time else None,
+        'length': movie.length,
+    }
+
+
+def _movie_detail(data):
+    """转换为可以用属性访问的对象，和Movie对象一样在模板中使用movie.title、movie.tag.name"""
+    data = dict(data, tag=SimpleNamespace(**data['tag']))
+    return SimpleNamespace(**data)
+
+
+def set_movie_detail(movie):
+    """缓存电影详情，后台添加和修改电影后调用，没有标签的电影在播放页不显示，作为不存在的电影缓存"""
+    if movie.tag is None:
+        stampede.put(MOVIE_DETAIL_KEY.format(movie.id), None, current_app.config['MOVIE_DETAIL_NEGATIVE_TIMEOUT'], 0)
+        return None
+    data = _movie_detail_data(movie)
+    stampede.put(MOVIE_DETAIL_KEY.format(movie.id), data, current_app.config['MOVIE_DETAIL_CACHE_TIMEOUT'])
+    return _movie_detail(data)
+
+
+def _load_movie_detail(movie_id):
+    movie = Movie.query.join(Tag).filter(
+        Tag.id == Movie.tag_id,
+        Movie.id == movie_id
+    ).first()
+    return _movie_detail_data(movie) if movie is not None else None
+
+
+def get_movie_detail(movie_id):
+    """读取电影详情，缓存中没有时查询数据库并缓存，电影不存在返回None，不存在的id也缓存一段时间"""
+    movie_id = int(movie_id)
+    data = stampede.get(
+        MOVIE_DETAIL_KEY.format(movie_id), lambda: _load_movie_detail(movie_id),
+        current_app.config['MOVIE_DETAIL_CACHE_TIMEOUT'],
+        negative_ttl=current_app.config['MOVIE_DETAIL_NEGATIVE_TIMEOUT'], name='movie_detail'
+    )
+    return _movie_detail(data) if data is not None else None
+
+
+def invalidate_movie_detail(*movie_ids):
+    """删除电影详情缓存，下次访问时重新查询，修改标签时一个标签下的电影可能很多，分批删除"""
+    movie_ids = list(movie_ids)
+    for i in range(0, len(movie_ids), 1000):
+        stampede.delete(*[MOVIE_DETAIL_KEY.format(movie_id) for movie_id in movie_ids[i:i + 1000]])
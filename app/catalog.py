@@ -0,0 +1,22 @@
+from app import tiercache
+from app.models import Tag, Auth, Role
+
+# 首页和后台表单每次都要用到的小表，使用两级缓存，后台修改后调用对应函数的invalidate()
+
+
+@tiercache.cached('tags')
+def tags():
+    """全部标签：[{'id': 标签id, 'name': 标签名称}]"""
+    return [{'id': tag.id, 'name': tag.name} for tag in Tag.query.order_by(Tag.id)]
+
+
+@tiercache.cached('auths')
+def auths():
+    """全部权限：[(权限id, 权限名称)]"""
+    return [(auth.id, auth.name) for auth in Auth.query.order_by(Auth.id)]
+
+
+@tiercache.cached('roles')
+def roles():
+    """全部角色：[(角色id, 角色名称)]"""
+    return [(role.id, role.name) for role in Role.query.order_by(Role.id)]
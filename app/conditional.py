@@ -0,0 +1,98 @@
+import hashlib
+import time
+from datetime import datetime
+from functools import wraps
+from flask import g, request, session, make_response, current_app
+from app import rd
+
+# 首页、预告和播放页的条件请求：根据电影、标签、预告等数据的版本号生成ETag和Last-Modified
+# 浏览器再次访问时带上If-None-Match或If-Modified-Since，数据没有变化直接返回304，不查询数据库也不渲染模板
+
+# 数据的版本号和最后修改时间，hash结构：字段"movie"为版本号，"movie:time"为最后修改时间
+STAMP_KEY = "catalog:stamp"
+
+
+def touch(*tables):
+    """后台修改数据后调用，tables为movie、tag、preview、comment等，使依赖这些数据的页面的ETag变化"""
+    now = int(time.time())
+    pipe = rd.pipeline()
+    for table in tables:
+        pipe.hincrby(STAMP_KEY, table, 1)
+        pipe.hset(STAMP_KEY, table + ':time', now)
+    pipe.execute()
+
+
+def _stamps(tables):
+    """返回(版本号字符串, 最后修改时间戳)，还没有修改时间时以当前时间作为修改时间"""
+    fields = []
+    for table in tables:
+        fields.extend([table, table + ':time'])
+    values = rd.hmget(STAMP_KEY, fields)
+    versions, modified = [], 0
+    for i, table in enumerate(tables):
+        changed = values[i * 2 + 1]
+        if changed is None:
+            changed = int(time.time())
+            rd.hsetnx(STAMP_KEY, table + ':time', changed)
+        versions.append('{}{}'.format(table, int(values[i * 2] or 0)))
+        modified = max(modified, int(changed))
+    return '.'.join(versions), modified
+
+
+def _validators(tables, extra, max_age, live):
+    """生成(ETag, Last-Modified, 页面版本)：数据版本号、登录用户和extra都相同时页面版本才相同
+    max_age为页面允许延迟的秒数(例如播放量排序的缓存时间)，每隔max_age秒页面版本变化一次
+    live为页面中每次请求时填入、不在页面缓存中的部分(例如播放量)，只影响ETag
+    """
+    version, modified = _stamps(tables)
+    user = session.get('login_user_id', '')
+    parts = [version, str(user), str(extra)]
+    if max_age:
+        bucket = int(time.time()) // max_age
+        parts.append(str(bucket))
+        modified = max(modified, bucket * max_age)
+    page_version = hashlib.md5('|'.join(parts).encode()).hexdigest()
+    etag = hashlib.md5('|'.join([page_version, str(live)]).encode()).hexdigest()
+    return etag, datetime.utcfromtimestamp(modified), page_version
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def serve(tables, render, extra='', max_age=None, live=''):
+    """GET请求先比较ETag和Last-Modified，没有变化时返回304，否则调用render()并加上ETag和Last-Modified
+    有闪现消息时页面只显示一次，不使用条件请求
+    页面版本保存在g.page_version中，页面缓存(pagecache)的键包含页面版本，数据修改后不会返回旧的页面
+    """
+    if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        return render()
+    etag, last_modified, g.page_version = _validators(tables, extra, max_age, live)
+    # live的变化没有修改时间，只能通过ETag验证
+    if _not_modified(etag, last_modified if live == '' else None):
+        resp = current_app.response_class(status=304)
+    else:
+        resp = make_response(render())
+        if resp.status_code != 200:
+            return resp
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    # 浏览器可以缓存，但每次使用前都要验证；页面和登录用户有关，代理服务器不能缓存
+    resp.cache_control.no_cache = True
+    resp.cache_control.private = True
+    return resp
+
+
+def depends_on(*tables, max_age_config=None):
+    """视图装饰器：页面只依赖tables中的数据，max_age_config为允许延迟的秒数的配置名称"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            max_age = current_app.config[max_age_config] if max_age_config else None
+            return serve(tables, lambda: func(*args, **kwargs), max_age=max_age)
+        return wrapper
+    return decorator
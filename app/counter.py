@@ -0,0 +1,103 @@
+import uuid
+from datetime import datetime, timedelta
+from redis.exceptions import LockError, WatchError
+from sqlalchemy import case
+from flask import current_app
+from app import cache, db, rd
+from app.models import Movie, PlayNumFlush
+
+# 还未写入数据库的播放量增量，hash结构：字段为电影id，值为增量
+PLAY_NUM_PENDING_KEY = "movie:play_num:pending"
+# 正在写入数据库的播放量增量，写入成功后删除，写入失败则保留到下次重试
+PLAY_NUM_FLUSHING_KEY = "movie:play_num:flushing"
+# 写入数据库的间隔锁，同一时间间隔内只有一个请求负责写入
+PLAY_NUM_FLUSH_LOCK_KEY = "movie:play_num:flush_lock"
+# 正在写入时加锁，避免写入时间超过间隔时多个进程同时写入同一批增量
+PLAY_NUM_WRITING_LOCK_KEY = "movie:play_num:writing_lock"
+# 正在写入的增量中保存批次编号的字段，批次编号和播放量在同一个事务中写入数据库
+PLAY_NUM_BATCH_FIELD = "batch"
+# 已经写入的批次记录保留的时间，超过后删除
+PLAY_NUM_BATCH_RETENTION = timedelta(days=1)
+
+
+def incr_play_num(movie_id):
+    """播放量加1：只在redis中累加，每隔一段时间由某一个请求批量写入数据库，避免每次播放都更新同一行"""
+    rd.hincrby(PLAY_NUM_PENDING_KEY, str(movie_id), 1)
+    if rd.set(PLAY_NUM_FLUSH_LOCK_KEY, 1, nx=True, ex=current_app.config['PLAY_NUM_FLUSH_INTERVAL']):
+        flush_play_nums()
+
+
+def flush_play_nums():
+    """将redis中累加的播放量用一条UPDATE语句写入数据库，返回写入的电影数量，其他进程正在写入时直接返回0"""
+    lock = rd.lock(PLAY_NUM_WRITING_LOCK_KEY, timeout=60)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        return _flush_play_nums()
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            pass  # 写入时间超过锁的时间，锁已经过期或者被其他进程拿到
+
+
+def _flush_play_nums():
+    if not rd.exists(PLAY_NUM_FLUSHING_KEY):
+        # 上次写入失败的增量还在时先写入上次的，否则把当前的增量整体改名，之后的播放会累加到新的hash中
+        if not rd.exists(PLAY_NUM_PENDING_KEY):
+            return 0
+        rd.rename(PLAY_NUM_PENDING_KEY, PLAY_NUM_FLUSHING_KEY)
+    # 每批增量有一个批次编号，写入数据库后进程崩溃、没有删除这批增量时，下次根据批次编号跳过，不会重复累加
+    rd.hsetnx(PLAY_NUM_FLUSHING_KEY, PLAY_NUM_BATCH_FIELD, uuid.uuid4().hex)
+    data = {key.decode(): value.decode() for key, value in rd.hgetall(PLAY_NUM_FLUSHING_KEY).items()}
+    batch = data.pop(PLAY_NUM_BATCH_FIELD)
+    deltas = {int(movie_id): int(num) for movie_id, num in data.items()}
+    flush_table = PlayNumFlush.__table__
+    with db.engine.begin() as conn:
+        done = conn.execute(flush_table.select().where(flush_table.c.batch == batch)).first()
+        if deltas and not done:
+            movie_table = Movie.__table__
+            conn.execute(
+                movie_table.update().where(
+                    movie_table.c.id.in_(list(deltas))
+                ).values(
+                    play_num=movie_table.c.play_num + case(deltas, value=movie_table.c.id, else_=0)
+                )
+            )
+            now = datetime.now()
+            # 批次编号是主键，同时写入同一批增量时后提交的事务失败回滚
+            conn.execute(flush_table.insert().values(batch=batch, add_time=now))
+            conn.execute(flush_table.delete().where(flush_table.c.add_time < now - PLAY_NUM_BATCH_RETENTION))
+    if deltas:
+        cache.invalidate_movie_detail(*deltas)  # 详情缓存中的播放量已经过时
+    _delete_batch(batch)
+    return 0 if done else len(deltas)
+
+
+def _delete_batch(batch):
+    """只删除本次写入的这批增量，锁过期后其他进程已经开始写入下一批时不会误删"""
+    with rd.pipeline() as pipe:
+        try:
+            pipe.watch(PLAY_NUM_FLUSHING_KEY)
+            if pipe.hget(PLAY_NUM_FLUSHING_KEY, PLAY_NUM_BATCH_FIELD) == batch.encode():
+                pipe.multi()
+                pipe.delete(PLAY_NUM_FLUSHING_KEY)
+                pipe.execute()
+        except WatchError:
+            pass
+
+
+def play_nums(movies):
+    """返回{电影id: 播放量}，播放量为数据库中的值加上还未写入数据库的增量，用于页面显示"""
+    movies = list(movies)
+    if not movies:
+        return {}
+    movie_ids = [str(movie.id) for movie in movies]
+    pipe = rd.pipeline()
+    pipe.hmget(PLAY_NUM_PENDING_KEY, movie_ids)
+    pipe.hmget(PLAY_NUM_FLUSHING_KEY, movie_ids)
+    pending, flushing = pipe.execute()
+    return {
+        movie.id: (movie.play_num or 0) + int(pending[i] or 0) + int(flushing[i] or 0)
+        for i, movie in enumerate(movies)
+    }
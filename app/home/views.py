@@ -1,11 +1,11 @@
 from . import home
-from flask import render_template, redirect, url_for, flash, session, request
+from flask import render_template, redirect, url_for, flash, session, request, abort, current_app
 from .forms import RegisterForm, LoginFrom, UserDetailForm, PwdForm, CommentForm
-from app.models import User, UserLog, Preview, Movie, MovieCollect, Comment, Tag
+from app.models import User, UserLog, Preview, Movie, MovieCollect, Comment
 from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
-import os
-from app import db, app
+from app import db, barrage, cache, catalog, conditional, counter, logwriter, media, pagecache, storage, thumbnail, search as movie_search
+from app.pagination import cursor_paginate
+from flask_sqlalchemy import Pagination
 import uuid
 from functools import wraps
 
@@ -30,8 +30,10 @@ def init():
 
 # 首页展示
 @home.route("/index/<int:page>/", methods=["GET"])
+@conditional.depends_on('movie', 'tag', max_age_config='INDEX_CACHE_TIMEOUT')
+@pagecache.cached
 def index(page=None):
-    all_tag = Tag.query.all()
+    all_tag = catalog.tags()
     # 星级转换
     star_list = [(1, '1星'), (2, '2星'), (3, '3星'), (4, '4星'), (5, '5星')]
     all_star = map(lambda x: {'num': x[0], 'info': x[1]}, star_list)
@@ -42,61 +44,20 @@ def index(page=None):
     # print(year_range)
 
     selected = dict()
-    page_movies = Movie.query
-    # 标签
-    tag_id = request.args.get('tag_id', 0)  # 获取链接中的标签id，0为显示所有
-    if int(tag_id) != 0:
-        page_movies = page_movies.filter_by(tag_id=tag_id)
-    selected['tag_id'] = tag_id
-
-    # 星级
-    star_num = request.args.get('star_num', 0)  # 获取星级数字，0为显示所有
-    if int(star_num) != 0:
-        page_movies = page_movies.filter_by(star=star_num)
-    selected['star_num'] = int(star_num)
-
-    # 时间
-    time_year = request.args.get('time_year', 1)  # 1为所有日期，0为更早，月份为所选
-    from sqlalchemy import extract
-    if int(time_year) == 0:
-        page_movies = page_movies.order_by(
-            Movie.add_time.asc()
-        )  # 更早的年份
-    elif int(time_year) == 1:
-        page_movies = page_movies.order_by(
-            Movie.add_time.desc()
-        )  # 所有年份的电影
-    else:
-        page_movies = page_movies.filter(extract('year', Movie.release_time) == time_year)  # 筛选年份
-    selected['time_year'] = time_year
-
-    # 播放量
-    play_num = request.args.get('play_num', 1)  # 1为从高到低，0为从低到好
-    if int(play_num) == 1:
-        page_movies = page_movies.order_by(
-            Movie.play_num.desc()
-        )
-    else:
-        page_movies = page_movies.order_by(
-            Movie.play_num.asc()
-        )
-    selected['play_num'] = play_num
-
-    # 评论
-    comment_num = request.args.get('comment_num', 1)  # 1为从高到低，0为从低到好
-    if int(comment_num) == 1:
-        page_movies = page_movies.order_by(
-            Movie.comment_num.desc()
-        )
-    else:
-        page_movies = page_movies.order_by(
-            Movie.comment_num.asc()
-        )
-    selected['comment_num'] = comment_num
+    selected['tag_id'] = request.args.get('tag_id', 0)  # 获取链接中的标签id，0为显示所有
+    selected['star_num'] = int(request.args.get('star_num', 0))  # 获取星级数字，0为显示所有
+    selected['time_year'] = request.args.get('time_year', 1)  # 1为所有日期，0为更早，月份为所选
+    selected['play_num'] = request.args.get('play_num', 1)  # 1为从高到低，0为从低到好
+    selected['comment_num'] = request.args.get('comment_num', 1)  # 1为从高到低，0为从低到好
 
     if page is None:
         page = 1
-    page_movies = page_movies.paginate(page=page, per_page=10)
+    # 先从redis中获取当前筛选条件下的电影id和总数，没有缓存才查询数据库
+    # 同一筛选条件的缓存过期时只有一个请求查询数据库，其他请求先使用过期的结果
+    cached = cache.get_index_page(selected, page)
+    movies = Movie.query.filter(Movie.id.in_(cached['ids'])).all() if cached['ids'] else []
+    movies.sort(key=lambda movie: cached['ids'].index(movie.id))  # 按照缓存中的顺序排列
+    page_movies = Pagination(None, page, 10, cached['total'], movies)
     return render_template('home/index.html',
                            all_tag=all_tag,
                            all_star=all_star,
@@ -108,6 +69,7 @@ def index(page=None):
 
 # 预览图展示
 @home.route("/indexbanner/")
+@conditional.depends_on('preview')
 def indexbanner():
     previews = Preview.query.all()
     return render_template('home/indexbanner.html', previews=previews)
@@ -125,12 +87,8 @@ def login():
             return redirect(url_for('home.login'))
         session['login_user'] = user.name
         session['login_user_id'] = user.id
-        userlog = UserLog(
-            user_id=user.id,
-            ip=request.remote_addr
-        )
-        db.session.add(userlog)
-        db.session.commit()
+        # 登录日志先保存在redis中，定时批量写入数据库
+        logwriter.write(UserLog, user_id=user.id, ip=request.remote_addr)
         return redirect(url_for('home.user'))
     return render_template('home/login.html', form=form)
 
@@ -178,23 +136,6 @@ def user():
     form.face.render_kw = {'required': False}
     if form.validate_on_submit():
         data = form.data
-        face_save_path = app.config['USER_IMAGE']
-        if not os.path.exists(face_save_path):
-            os.makedirs(face_save_path)  # 如果文件保存路径不存在，则创建一个多级目录
-            import stat
-            os.chmod(face_save_path, stat.S_IRWXU)  # 授予可读写权限
-
-        if form.face.data:
-            # 上传文件不为空保存
-            if login_user.face and os.path.exists(os.path.join(face_save_path, login_user.face)):
-                os.remove(os.path.join(face_save_path, login_user.face))
-            # 获取上传文件名称
-            file_face = secure_filename(form.face.data.filename)
-            # !!!AttributeError: 'str' object has no attribute 'filename'，前端需要加上enctype="multipart/form-data"
-            from app.admin.views import change_filename
-            login_user.face = change_filename(file_face)
-            form.face.data.save(face_save_path + login_user.face)
-
         if login_user.name != data['name'] and User.query.filter_by(name=data['name']).count() == 1:
             flash('昵称已经存在', 'err')
             return redirect(url_for('home.user'))
@@ -212,7 +153,19 @@ def user():
 
         login_user.info = data['info']
 
+        # 检查完昵称、邮箱和手机号再保存头像，不会保存没有使用的文件
+        old_face = login_user.face
+        if form.face.data:
+            # 上传文件不为空保存
+            # !!!AttributeError: 'str' object has no attribute 'filename'，前端需要加上enctype="multipart/form-data"
+            login_user.face, created = storage.save(form.face.data, root='image')
+            if created:
+                thumbnail.submit(login_user.face, root='image')
+
         db.session.commit()
+        conditional.touch('comment')  # 播放页的评论中显示会员名称和头像
+        if form.face.data and old_face:
+            storage.release.delay(old_face, 'image')  # 提交后在后台删除旧头像，上传相同的头像时只减少引用计数
         flash('修改资料成功', 'ok')
         return redirect(url_for('home.user'))
     return render_template('home/user.html', form=form, login_user=login_user)
@@ -243,11 +196,9 @@ def pwd():
 def comments(page):
     if not page:
         page = 1
-    page_comments = Comment.query.filter_by(
+    page_comments = cursor_paginate(Comment.query.filter_by(
         user_id=int(session['login_user_id'])
-    ).order_by(
-        Comment.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    ), Comment, page=page, per_page=10)
     return render_template('home/comments.html', page_comments=page_comments)
 
 
@@ -258,28 +209,25 @@ def userlog(page=None):
     """会员登录日志"""
     if not page:
         page = 1
-    page_user_logs = UserLog.query.filter_by(
+    logwriter.flush()  # 先写入还在redis中的日志
+    page_user_logs = cursor_paginate(UserLog.query.filter_by(
         user_id=int(session['login_user_id'])
-    ).order_by(
-        UserLog.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    ), UserLog, page=page, per_page=10)
     return render_template('home/userlog.html', page_user_logs=page_user_logs)
 
 
 # 搜索
 @home.route('/search/<int:page>')
+@pagecache.cached
 def search(page=None):
     if page is None:
         page = 1
-    keyword = request.args.get('keyword')
-    search_count = Movie.query.filter(
-        Movie.title.ilike("%" + keyword + "%")
-    ).count()
-    search_movies = Movie.query.filter(
-        Movie.title.ilike("%" + keyword + "%")
-    ).order_by(
-        Movie.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    keyword = request.args.get('keyword', '')
+    # 通过倒排索引搜索，得到排好序的电影id和结果总数，不需要扫描整张电影表
+    movie_ids, search_count = movie_search.search(keyword, page=page, per_page=10)
+    movies = Movie.query.filter(Movie.id.in_(movie_ids)).all() if movie_ids else []
+    movies.sort(key=lambda movie: movie_ids.index(movie.id))  # 按照搜索结果的顺序排列
+    search_movies = Pagination(None, page, 10, search_count, movies)
     search_movies.key = keyword
     return render_template('home/search.html', keyword=keyword, search_movies=search_movies, search_count=search_count)
 
@@ -287,14 +235,13 @@ def search(page=None):
 # 播放界面
 @home.route('/play/<int:movie_id>/page/<int:page>/', methods=['GET', 'POST'])
 def play(movie_id=None, page=None):
-    movie = Movie.query.join(Tag).filter(
-        Tag.id == Movie.tag_id,
-        Movie.id == int(movie_id)
-    ).first_or_404()
+    # 电影详情(包括标签名称)从缓存读取，只有缓存中没有时才查询数据库
+    movie = cache.get_movie_detail(movie_id)
+    if movie is None:
+        abort(404)
 
     if request.method == 'GET' and int(request.args.get('page', 0)) != 1:
-        movie.play_num += 1  # 访问量加1
-        db.session.commit()
+        counter.incr_play_num(movie.id)  # 访问量加1，先累加在redis中，定时批量写入数据库
 
     form = CommentForm()
     if 'login_user' not in session:
@@ -311,25 +258,52 @@ def play(movie_id=None, page=None):
             user_id=session['login_user_id']
         )
         db.session.add(comment)
-        movie.comment_num += 1
+        Movie.query.filter_by(id=movie.id).update({Movie.comment_num: Movie.comment_num + 1})
         db.session.commit()
+        cache.invalidate_movie_detail(movie.id)  # 评论量变化，详情缓存失效
+        conditional.touch('comment')
         flash('评论成功', category='ok')
         return redirect(url_for('home.play', movie_id=movie.id, page=1))
 
     if page is None:
         page = 1
-    # 查询的时候关联标签，采用join来加进去,多表关联用filter,过滤用filter_by
-    page_comments = Comment.query.join(
-        Movie
-    ).join(
-        User
-    ).filter(
-        Movie.id == movie.id,
-        User.id == Comment.user_id
-    ).order_by(
-        Comment.add_time.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template('home/play.html', movie=movie, form=form, page_comments=page_comments)
+
+    def render():
+        # 查询的时候关联标签，采用join来加进去,多表关联用filter,过滤用filter_by
+        # 按照(add_time, id)游标分页，评论再多翻页也不会变慢
+        page_comments = cursor_paginate(Comment.query.join(
+            Movie
+        ).join(
+            User
+        ).filter(
+            Movie.id == movie.id,
+            User.id == Comment.user_id
+        ), Comment, page=page, per_page=10)
+        # 播放量每次请求都不同，页面缓存中只保存占位符
+        return render_template('home/play.html', movie=movie, form=form, page_comments=page_comments,
+                               play_num=pagecache.hole('play_num'))
+    # 显示数据库中的播放量加上redis中还没有写入的播放量
+    play_num = counter.play_nums([movie])[movie.id]
+    # 播放量在上面已经累加；电影、标签、评论和播放量没有变化时返回304，未登录用户的页面使用缓存
+    # 登录用户的页面中有评论表单的csrf token，在token过期之前让ETag变化
+    max_age = None
+    if 'login_user' in session:
+        max_age = (current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) // 2
+    return conditional.serve(('movie', 'tag', 'comment'),
+                             lambda: pagecache.serve(render, holes={'play_num': play_num}),
+                             extra=movie.comment_num, max_age=max_age, live=play_num)
+
+
+# 电影文件，支持拖动进度条时的Range请求
+@home.route('/media/<path:filename>', methods=['GET'])
+def media_file(filename):
+    return media.send_media(filename)
+
+
+# 按时间拖动进度条时查询关键帧的文件偏移，参数t为秒数
+@home.route('/media/seek/<path:filename>', methods=['GET'])
+def media_seek(filename):
+    return media.seek(filename, request.args.get('t', 0, type=float))
 
 
 # 添加收藏
@@ -363,11 +337,9 @@ def add_moviecollect():
 def moviecollect(page):
     if not page:
         page = 1
-    page_moviecollects = MovieCollect.query.filter_by(
+    page_moviecollects = cursor_paginate(MovieCollect.query.filter_by(
         user_id=int(session['login_user_id'])
-    ).order_by(
-        MovieCollect.add_time.desc()
-    ).paginate(page=page, per_page=10)
+    ), MovieCollect, page=page, per_page=10)
     return render_template('home/moviecollect.html', page_moviecollects=page_moviecollects)
 
 
@@ -375,40 +347,46 @@ def moviecollect(page):
 @home.route("/tm/v3/", methods=["GET", "POST"])
 def tm():
     from flask import Response
-    from app import rd
     import json
     import datetime
     import time
     resp = ''
     if request.method == "GET":  # 获取弹幕
-        movie_id = request.args.get('id')  # 用id来获取弹幕消息队列，也就是js中danmaku配置的id
-        key = "movie{}:barrage".format(movie_id)  # 拼接形成键值用于存放在redis队列中
-        if rd.llen(key):
-            msgs = rd.lrange(key, 0, 2999)
-            tm_data = []
-            for msg in msgs:
-                msg = json.loads(msg)
-                # print(msg)
-                tmp_data = [msg['time'], msg['type'], msg['date'], msg['author'], msg['text']]
-                tm_data.append(tmp_data)
-            # print(tm_data)
-            res = {
-                "code": 0,
-                # 参照官网http://dplayer.js.org/#/ 获取弹幕的消息格式
-                # "data": [[6.978, 0, 16777215, "DIYgod", "1111111111111111111"],
-                #          [16.338, 0, 16777215, "DIYgod", "测试"],
-                #          [8.177, 0, 16777215, "DIYgod", "测试"],
-                #          [7.358, 0, 16777215, "DIYgod", "1"],
-                #          [15.748338, 0, 16777215, "DIYgod", "owo"]],
-                "data": tm_data,
-            }
+        movie_id = request.args.get('id')  # 用id来获取弹幕消息，也就是js中danmaku配置的id
+        if not {'start', 'end', 'max'} & set(request.args):
+            # 不指定时间区间时直接返回编码好的全部弹幕，弹幕没有变化时返回304
+            etag = barrage.etag(movie_id)
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+            else:
+                etag, body = barrage.payload(movie_id)
+                if body:
+                    resp = Response(b'{"code": 0, "data": [' + body + b']}', mimetype='application/json')
+                else:
+                    resp = Response(json.dumps({"code": 1, "data": []}), mimetype='application/json')
+            resp.set_etag(etag)
+            resp.cache_control.no_cache = True  # 每次都需要带上ETag来验证
+            return resp
+        # 只获取视频时间在[start, end]之间的弹幕，max为最多返回的数量(DPlayer的maximum配置)
+        start = request.args.get('start', '-inf')
+        end = request.args.get('end', '+inf')
+        max_num = request.args.get('max', None, type=int)
+        try:
+            start, end = float(start), float(end)
+        except ValueError:
+            return Response(json.dumps({"code": 1, "data": []}), mimetype='application/json')
+        # 参照官网http://dplayer.js.org/#/ 获取弹幕的消息格式
+        # "data": [[6.978, 0, 16777215, "DIYgod", "1111111111111111111"],
+        #          [16.338, 0, 16777215, "DIYgod", "测试"]]
+        tm_data = barrage.fetch(movie_id, start, end, max_num)  # 已经编码好的json数组，直接拼接
+        if tm_data:
+            resp = '{"code": 0, "data": [' + ', '.join(tm_data) + ']}'
         else:
-            print('Redis中暂无内容')
             res = {
                 "code": 1,  # 无内容code为1
                 "data": []
             }
-        resp = json.dumps(res)
+            resp = json.dumps(res)
     if request.method == "POST":  # 添加弹幕
         data = json.loads(request.get_data())
         # print(data)
@@ -429,5 +407,25 @@ def tm():
             "data": msg
         }
         resp = json.dumps(res)
-        rd.lpush("movie{}:barrage".format(data['id']), json.dumps(msg))  # 将添加的弹幕推入redis的队列中
+        barrage.add(data['id'], msg)  # 按照视频时间存入redis的有序集合中
     return Response(resp, mimetype='application/json')
+
+
+# 推送新弹幕，播放页面通过EventSource连接，不需要反复请求全部弹幕
+@home.route("/tm/v3/stream/", methods=["GET"])
+def tm_stream():
+    from flask import Response, stream_with_context, abort
+    movie_id = request.args.get('id', type=int)
+    if movie_id is None:
+        abort(404)
+    listener = barrage.subscribe(movie_id)
+    if listener is None:
+        # 本进程的推送连接已满，浏览器的EventSource稍后自动重连
+        resp = Response(status=503)
+        resp.headers['Retry-After'] = 10
+        return resp
+    resp = Response(stream_with_context(barrage.stream(movie_id, listener)), mimetype='text/event-stream')
+    resp.call_on_close(lambda: barrage.unsubscribe(movie_id, listener))  # 还没有开始推送就断开时也要释放
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # 关闭nginx的缓冲，消息才能立即推送
+    return resp
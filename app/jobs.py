@@ -0,0 +1,96 @@
+import json
+import time
+import traceback
+import uuid
+from flask import current_app, g
+from app import rd
+
+# 等待执行的任务，list结构，左边进右边出
+QUEUE_KEY = "jobs:queue"
+# 每个worker正在执行的任务，worker异常退出后重新启动时放回队列
+PROCESSING_KEY = "jobs:processing:{}"
+# 失败后等待重试的任务，有序集合，分数为可以重试的时间
+DELAYED_KEY = "jobs:delayed"
+# 重试次数用完仍然失败的任务，保留错误信息，可以用manage.py retry_dead_jobs重新执行
+DEAD_KEY = "jobs:dead"
+
+# 已注册的任务：{任务名: 函数}
+_tasks = {}
+
+
+def task(func):
+    """注册为后台任务，调用func.delay(*args)放入队列，参数需要可以json序列化"""
+    name = func.__module__ + '.' + func.__name__
+    _tasks[name] = func
+    func.delay = lambda *args: enqueue(name, *args)
+    return func
+
+
+def enqueue(name, *args):
+    """把任务放入队列，JOBS_EAGER开启时直接执行(本地开发和测试不需要启动worker)"""
+    if current_app.config['JOBS_EAGER']:
+        with current_app.app_context():
+            _tasks[name](*args)
+        return None
+    job_id = uuid.uuid4().hex
+    rd.lpush(QUEUE_KEY, json.dumps({'id': job_id, 'task': name, 'args': args, 'attempts': 0}))
+    return job_id
+
+
+def _schedule_delayed():
+    """把已经到了重试时间的任务放回队列"""
+    for data in rd.zrangebyscore(DELAYED_KEY, 0, time.time()):
+        if rd.zrem(DELAYED_KEY, data):  # 删除成功的worker负责放回队列，避免重复执行
+            rd.lpush(QUEUE_KEY, data)
+
+
+def _run(data):
+    """执行一个任务，失败时按照指数退避重试，超过重试次数放入死信列表"""
+    job = json.loads(data)
+    try:
+        func = _tasks[job['task']]
+        with current_app.app_context():
+            g.job_id = job['id']  # 任务可能重复执行，需要幂等的任务可以根据任务id判断是否已经执行过
+            func(*job['args'])
+    except Exception:
+        job['attempts'] += 1
+        job['error'] = traceback.format_exc()
+        if job['attempts'] > current_app.config['JOBS_MAX_RETRIES']:
+            rd.lpush(DEAD_KEY, json.dumps(job))
+            current_app.logger.error('任务%s失败：%s', job['task'], job['error'])
+        else:
+            delay = current_app.config['JOBS_RETRY_DELAY'] * 2 ** (job['attempts'] - 1)
+            rd.zadd(DELAYED_KEY, {json.dumps(job): time.time() + delay})
+
+
+def work(name, burst=False):
+    """worker主循环，name在重启后保持不变才能找回上次没有完成的任务，burst为True时队列为空就退出"""
+    processing = PROCESSING_KEY.format(name)
+    while rd.rpoplpush(processing, QUEUE_KEY):
+        pass  # 上次异常退出时没有完成的任务放回队列
+    while True:
+        _schedule_delayed()
+        if burst:
+            data = rd.rpoplpush(QUEUE_KEY, processing)
+            if data is None:
+                return
+        else:
+            data = rd.brpoplpush(QUEUE_KEY, processing, timeout=1)
+            if data is None:
+                continue
+        _run(data)
+        rd.lrem(processing, 1, data)
+
+
+def retry_dead():
+    """把死信列表中的任务重新放入队列，返回数量"""
+    num = 0
+    while True:
+        data = rd.rpop(DEAD_KEY)
+        if data is None:
+            return num
+        job = json.loads(data)
+        job['attempts'] = 0
+        job.pop('error', None)
+        rd.lpush(QUEUE_KEY, json.dumps(job))
+        num += 1
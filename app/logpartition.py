@@ -0,0 +1,140 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, literal, select, text
+from flask import current_app
+from app import db
+from app.models import UserLog, AdminLog, OperateLog, LogDaily
+
+# 按月分区的日志表，以及每日汇总时按照哪个字段统计
+LOG_OWNERS = {
+    UserLog.__table__: UserLog.__table__.c.user_id,
+    AdminLog.__table__: AdminLog.__table__.c.admin_id,
+    OperateLog.__table__: OperateLog.__table__.c.admin_id,
+}
+# 分区名称：p201910保存2019年10月的日志，pmax保存还没有创建分区的月份
+PARTITION_NAME = "p%Y%m"
+
+
+def _add_months(day, months):
+    """返回day所在月份加上months个月后的第一天"""
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def _is_mysql():
+    """只有mysql支持分区，sqlite等本地测试数据库直接删除过期的行"""
+    return db.engine.dialect.name == 'mysql'
+
+
+def _partitions(conn, table):
+    """返回表已有的按月分区的名称，表还没有分区时返回None"""
+    names = [name for name, in conn.execute(text(
+        "select partition_name from information_schema.partitions "
+        "where table_schema = database() and table_name = :table and partition_name is not null"
+    ), table=table.name)]
+    return sorted(name for name in names if name != 'pmax') if names else None
+
+
+def _partition_sql(months):
+    """生成months中每个月的分区定义，最后加上pmax"""
+    parts = ["partition {} values less than ('{}')".format(
+        month.strftime(PARTITION_NAME), _add_months(month, 1).isoformat()
+    ) for month in months]
+    parts.append("partition pmax values less than (maxvalue)")
+    return ', '.join(parts)
+
+
+def ensure_partitions(months_ahead=None):
+    """为本月和之后months_ahead个月创建分区，返回创建的分区数量
+    表还没有分区时改为按月分区，以前的日志都放在本月的分区中，按照本月的分区一起过期
+    之后每次从pmax中拆分出新的月份，pmax中没有数据，拆分很快
+    """
+    if not _is_mysql():
+        return 0
+    if months_ahead is None:
+        months_ahead = current_app.config['LOG_PARTITION_MONTHS_AHEAD']
+    this_month = _add_months(date.today(), 0)
+    months = [_add_months(this_month, i) for i in range(months_ahead + 1)]
+    num = 0
+    with db.engine.begin() as conn:
+        for table in LOG_OWNERS:
+            existing = _partitions(conn, table)
+            if existing is None:
+                # 分区表的主键必须包含分区字段
+                conn.execute(text(
+                    "alter table {} drop primary key, add primary key (id, add_time) "
+                    "partition by range columns(add_time) ({})".format(table.name, _partition_sql(months))
+                ))
+                num += len(months)
+                continue
+            new_months = [month for month in months if month.strftime(PARTITION_NAME) > (existing or [''])[-1]]
+            if new_months:
+                conn.execute(text("alter table {} reorganize partition pmax into ({})".format(
+                    table.name, _partition_sql(new_months)
+                )))
+                num += len(new_months)
+    return num
+
+
+def drop_expired(retention_months=None):
+    """删除保留时间之前的日志：mysql直接删除整个分区，不需要逐行删除，返回删除的分区(或行)数量"""
+    if retention_months is None:
+        retention_months = current_app.config['LOG_RETENTION_MONTHS']
+    cutoff = _add_months(date.today(), -retention_months)
+    num = 0
+    with db.engine.begin() as conn:
+        for table in LOG_OWNERS:
+            if not _is_mysql():
+                num += conn.execute(table.delete().where(table.c.add_time < cutoff)).rowcount
+                continue
+            expired = [name for name in _partitions(conn, table) or []
+                       if _add_months(datetime.strptime(name, PARTITION_NAME).date(), 1) <= cutoff]
+            if expired:
+                conn.execute(text("alter table {} drop partition {}".format(table.name, ', '.join(expired))))
+                num += len(expired)
+    return num
+
+
+def rollup(day):
+    """重新计算某一天的汇总，可以重复执行"""
+    start = datetime(day.year, day.month, day.day)
+    end = start + timedelta(days=1)
+    daily = LogDaily.__table__
+    with db.engine.begin() as conn:
+        for table, owner in LOG_OWNERS.items():
+            conn.execute(daily.delete().where(daily.c.day == day).where(daily.c.kind == table.name))
+            conn.execute(daily.insert().from_select(
+                ['day', 'kind', 'owner_id', 'num'],
+                select([
+                    literal(day, daily.c.day.type), literal(table.name), owner, func.count()
+                ]).where(
+                    table.c.add_time >= start
+                ).where(
+                    table.c.add_time < end
+                ).where(
+                    owner.isnot(None)
+                ).group_by(owner)
+            ))
+
+
+def maintain():
+    """每天执行一次：汇总前一天和当天的日志，创建新的分区，删除过期的分区"""
+    from app import logwriter
+    logwriter.flush()  # 还在redis中的日志也要统计
+    today = date.today()
+    rollup(today - timedelta(days=1))
+    rollup(today)
+    return ensure_partitions(), drop_expired()
+
+
+def daily_stats(days=30):
+    """最近days天每天的汇总：[(日期, {日志表名: (次数, 人数)})]，最新的在前"""
+    since = date.today() - timedelta(days=days - 1)
+    rows = db.session.query(
+        LogDaily.day, LogDaily.kind, func.sum(LogDaily.num), func.count(LogDaily.owner_id)
+    ).filter(
+        LogDaily.day >= since
+    ).group_by(LogDaily.day, LogDaily.kind)
+    stats = {}
+    for day, kind, num, owners in rows:
+        stats.setdefault(day, {})[kind] = (int(num), owners)
+    return sorted(stats.items(), reverse=True)
@@ -0,0 +1,113 @@
+import atexit
+import json
+import uuid
+from datetime import datetime, timedelta
+from redis.exceptions import LockError, WatchError
+from flask import current_app
+from app import db, rd
+from app.models import UserLog, AdminLog, OperateLog, LogFlush
+
+# 还未写入数据库的日志，list结构，每一项为{"table": 表名, "row": 字段}
+LOG_PENDING_KEY = "logs:pending"
+# 正在写入数据库的日志，写入成功后删除，写入失败则保留到下次重试
+LOG_FLUSHING_KEY = "logs:flushing"
+# 写入数据库的间隔锁，同一时间间隔内只有一个请求负责写入
+LOG_FLUSH_LOCK_KEY = "logs:flush_lock"
+# 正在写入时加锁，避免多个进程重复写入同一批日志
+LOG_WRITING_LOCK_KEY = "logs:writing_lock"
+# 正在写入的这批日志的批次编号，批次编号和日志在同一个事务中写入数据库
+LOG_BATCH_KEY = "logs:flushing:batch"
+# 已经写入的批次记录保留的时间，超过后删除
+LOG_BATCH_RETENTION = timedelta(days=1)
+# 可以批量写入的日志表
+LOG_MODELS = {model.__tablename__: model for model in (UserLog, AdminLog, OperateLog)}
+# 每条INSERT语句写入的最大行数
+BATCH_SIZE = 1000
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def write(model, **values):
+    """记录一条日志：先保存在redis中，每隔LOG_FLUSH_INTERVAL秒由某一个请求用多行INSERT批量写入数据库
+    日志时间为调用时的时间，不是写入数据库的时间
+    """
+    values.setdefault('add_time', datetime.now())
+    values['add_time'] = values['add_time'].strftime(TIME_FORMAT)
+    rd.rpush(LOG_PENDING_KEY, json.dumps({'table': model.__tablename__, 'row': values}))
+    if rd.set(LOG_FLUSH_LOCK_KEY, 1, nx=True, ex=current_app.config['LOG_FLUSH_INTERVAL']):
+        try:
+            flush()
+        except Exception:
+            # 写入失败的日志保留在redis中，下次重试，不影响触发写入的请求(例如登录)
+            current_app.logger.exception('批量写入日志失败')
+
+
+def flush():
+    """把redis中的日志批量写入数据库，返回写入的数量，其他进程正在写入时直接返回0"""
+    lock = rd.lock(LOG_WRITING_LOCK_KEY, timeout=60)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        return _flush()
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            pass  # 写入时间超过锁的时间，锁已经过期或者被其他进程拿到
+
+
+def _flush():
+    if not rd.exists(LOG_FLUSHING_KEY):
+        # 上次写入失败的日志还在时先写入上次的，否则把当前的日志整体改名，之后的日志会写入新的list
+        if not rd.exists(LOG_PENDING_KEY):
+            return 0
+        rd.rename(LOG_PENDING_KEY, LOG_FLUSHING_KEY)
+    # 每批日志有一个批次编号，写入数据库后进程崩溃、没有删除这批日志时，下次根据批次编号跳过，不会重复写入
+    rd.setnx(LOG_BATCH_KEY, uuid.uuid4().hex)
+    batch = rd.get(LOG_BATCH_KEY).decode()
+    rows = {}
+    for data in rd.lrange(LOG_FLUSHING_KEY, 0, -1):
+        item = json.loads(data)
+        row = item['row']
+        row['add_time'] = datetime.strptime(row['add_time'], TIME_FORMAT)
+        rows.setdefault(item['table'], []).append(row)
+    flush_table = LogFlush.__table__
+    with db.engine.begin() as conn:
+        done = conn.execute(flush_table.select().where(flush_table.c.batch == batch)).first()
+        if rows and not done:
+            for table, table_rows in rows.items():
+                insert = LOG_MODELS[table].__table__.insert()
+                for i in range(0, len(table_rows), BATCH_SIZE):
+                    conn.execute(insert.values(table_rows[i:i + BATCH_SIZE]))
+            now = datetime.now()
+            # 批次编号是主键，锁过期后同时写入同一批日志时后提交的事务失败回滚
+            conn.execute(flush_table.insert().values(batch=batch, add_time=now))
+            conn.execute(flush_table.delete().where(flush_table.c.add_time < now - LOG_BATCH_RETENTION))
+    _delete_batch(batch)
+    return 0 if done else sum(len(table_rows) for table_rows in rows.values())
+
+
+def _delete_batch(batch):
+    """只删除本次写入的这批日志，锁过期后其他进程已经开始写入下一批时不会误删"""
+    with rd.pipeline() as pipe:
+        try:
+            pipe.watch(LOG_BATCH_KEY)
+            if pipe.get(LOG_BATCH_KEY) == batch.encode():
+                pipe.multi()
+                pipe.delete(LOG_FLUSHING_KEY, LOG_BATCH_KEY)
+                pipe.execute()
+        except WatchError:
+            pass
+
+
+def _flush_on_exit(app):
+    """进程退出时写入剩余的日志，没有写入的日志保存在redis中，下次写入时不会丢失"""
+    with app.app_context():
+        try:
+            flush()
+        except Exception:
+            app.logger.exception('退出时写入日志失败')
+
+
+def init_app(app):
+    atexit.register(_flush_on_exit, app)
@@ -0,0 +1,139 @@
+import calendar
+import json
+import mimetypes
+import os
+import uuid
+from flask import request, Response, abort, safe_join, current_app
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+from app import mp4
+
+# 读取文件的缓冲大小
+BUFFER_SIZE = 64 * 1024
+
+
+def _read_range(f, start, length):
+    """从start开始读取length字节"""
+    f.seek(start)
+    while length > 0:
+        data = f.read(min(BUFFER_SIZE, length))
+        if not data:
+            break
+        length -= len(data)
+        yield data
+
+
+def _ranges(size, etag, last_modified):
+    """解析Range请求头，返回[(start, stop)]，不是Range请求或者If-Range不匹配时返回None，范围都无效时返回[]"""
+    rng = request.range
+    if rng is None or rng.units != 'bytes':
+        return None
+    if_range = request.if_range
+    if if_range.etag and if_range.etag != etag:
+        return None  # 文件已经变化，需要返回完整文件
+    if if_range.date and calendar.timegm(if_range.date.utctimetuple()) < int(last_modified):
+        return None
+    ranges = []
+    for begin, end in rng.ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size  # bytes=-500，最后500字节
+        else:
+            start, stop = begin, min(end or size, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def _media_path(filename):
+    """上传目录中的文件路径，文件不存在时返回404"""
+    if not filename or filename.startswith('.'):
+        abort(404)  # 不允许访问上传临时目录等隐藏文件
+    path = safe_join(current_app.config['UP_DIR'], filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return path
+
+
+def seek(filename, t):
+    """按时间拖动进度条：返回t秒之前最近的关键帧的时间和文件偏移，客户端直接从这个偏移发送Range请求"""
+    frame = mp4.seek(_media_path(filename), t)
+    if frame is None:
+        abort(404)  # 不是mp4或者还没有生成关键帧索引
+    return Response(json.dumps({'time': frame[0], 'offset': frame[1]}), mimetype='application/json')
+
+
+def send_media(filename):
+    """发送媒体文件，支持单个和多个Range请求、条件请求和缓存头
+    MEDIA_OFFLOAD为x-accel或x-sendfile时交给nginx或apache发送文件，python进程不读取文件内容
+    完整文件或者到文件结尾的Range请求使用服务器的wsgi.file_wrapper，gunicorn、uwsgi等会用sendfile零拷贝发送
+    """
+    path = _media_path(filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    resp = Response(mimetype=mimetype)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.config['MEDIA_CACHE_TIMEOUT']
+
+    offload = current_app.config['MEDIA_OFFLOAD']
+    if offload == 'x-accel':
+        resp.headers['X-Accel-Redirect'] = current_app.config['MEDIA_ACCEL_PREFIX'] + filename
+        return resp
+    if offload == 'x-sendfile':
+        resp.headers['X-Sendfile'] = path
+        return resp
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = "{:x}-{:x}".format(int(stat.st_mtime), size)
+    resp.set_etag(etag)
+    resp.last_modified = int(stat.st_mtime)
+    resp.headers['Accept-Ranges'] = 'bytes'
+    if not is_resource_modified(request.environ, etag=etag, last_modified=resp.last_modified):
+        resp.status_code = 304
+        return resp
+
+    ranges = _ranges(size, etag, stat.st_mtime)
+    if ranges == []:
+        resp.status_code = 416
+        resp.headers['Content-Range'] = 'bytes */{}'.format(size)
+        return resp
+
+    f = open(path, 'rb')
+    resp.call_on_close(f.close)
+    if ranges is None or len(ranges) == 1:
+        start, stop = ranges[0] if ranges else (0, size)
+        if ranges:
+            resp.status_code = 206
+            resp.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        if stop == size:
+            f.seek(start)
+            resp.response = wrap_file(request.environ, f, BUFFER_SIZE)
+        else:
+            resp.response = _read_range(f, start, stop - start)
+        resp.direct_passthrough = True
+        resp.content_length = stop - start
+        return resp
+
+    # 多个Range，按照multipart/byteranges格式返回
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, stop in ranges:
+        header = '--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+            boundary, mimetype, start, stop - 1, size
+        ).encode()
+        parts.append((header, start, stop))
+    ending = '--{}--\r\n'.format(boundary).encode()
+
+    def generate():
+        for header, start, stop in parts:
+            yield header
+            for data in _read_range(f, start, stop - start):
+                yield data
+            yield b'\r\n'
+        yield ending
+
+    resp.status_code = 206
+    resp.headers['Content-Type'] = 'multipart/byteranges; boundary={}'.format(boundary)
+    resp.response = generate()
+    resp.direct_passthrough = True
+    resp.content_length = sum(len(header) + stop - start + 2 for header, start, stop in parts) + len(ending)
+    return resp
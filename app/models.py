@@ -1,4 +1,5 @@
 from datetime import datetime
+from sqlalchemy.orm import validates
 from app import db
 
 # from flask_sqlalchemy import SQLAlchemy
@@ -23,10 +24,12 @@ class User(db.Model):
     email = db.Column(db.String(100), unique=True)  # 邮箱
     phone = db.Column(db.String(11), unique=True)  # 手机号码
     info = db.Column(db.Text)  # 个性简介
-    face = db.Column(db.String(255), unique=True)  # 头像
+    face = db.Column(db.String(255))  # 头像，相同内容的文件只保存一份，可以被多个会员使用
     add_time = db.Column(db.DateTime, index=True, default=datetime.now())  # 添加时间
     uuid = db.Column(db.String(255), unique=True)  # 唯一标识符
-    userlogs = db.relationship('UserLog', backref='user')  # 会员日志外键关系关联，backref互相绑定user表
+    # 日志表按月分区，mysql的分区表不支持外键，只在ORM中声明关联关系
+    userlogs = db.relationship('UserLog', primaryjoin='User.id == foreign(UserLog.user_id)',
+                               backref='user')  # 会员日志关系关联，backref互相绑定user表
     comments = db.relationship('Comment', backref='user')  # 用户评论外键关系关联
     moviecollects = db.relationship('MovieCollect', backref='user')  # 用户收藏电影外键关系关联
 
@@ -43,8 +46,10 @@ class User(db.Model):
 class UserLog(db.Model):
     __tablename__ = "userlog"
     # __table_args__ = {"useexisting": True}
+    # 个人登录日志按照(add_time, id)游标分页，需要联合索引
+    __table_args__ = (db.Index('ix_userlog_user_id_add_time', 'user_id', 'add_time', 'id'),)
     id = db.Column(db.Integer, primary_key=True)  # 编号
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 所属会员
+    user_id = db.Column(db.Integer)  # 所属会员
     ip = db.Column(db.String(100))  # 登录IP
     add_time = db.Column(db.DateTime, index=True, default=datetime.now())  # 登录时间
 
@@ -69,17 +74,27 @@ class Tag(db.Model):
 class Movie(db.Model):
     __tablename__ = 'movie'
     # __table_args__ = {"useexisting": True}
+    # 首页按照标签、星级、上映年份筛选，再按照添加时间或者播放量、评论量排序，联合索引和这些查询条件对应
+    __table_args__ = (
+        db.Index('ix_movie_tag_star_year_play', 'tag_id', 'star', 'release_year', 'play_num', 'comment_num'),
+        db.Index('ix_movie_tag_year_play', 'tag_id', 'release_year', 'play_num', 'comment_num'),
+        db.Index('ix_movie_star_year_play', 'star', 'release_year', 'play_num', 'comment_num'),
+        db.Index('ix_movie_year_play', 'release_year', 'play_num', 'comment_num'),
+        db.Index('ix_movie_tag_star_add_time', 'tag_id', 'star', 'add_time'),
+        db.Index('ix_movie_star_add_time', 'star', 'add_time'),
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     title = db.Column(db.String(255), unique=True)  # 标题
-    url = db.Column(db.String(255), unique=True)  # 播放地址
+    url = db.Column(db.String(255))  # 播放地址，按照文件内容保存，不同电影可以使用相同文件
     info = db.Column(db.Text)  # 简介
-    logo = db.Column(db.String(255), unique=True)  # 封面
+    logo = db.Column(db.String(255))  # 封面
     star = db.Column(db.SmallInteger)  # 星级
     play_num = db.Column(db.BigInteger)  # 播放量
     comment_num = db.Column(db.BigInteger)  # 评论量
     tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'))  # 所属标签
     area = db.Column(db.String(255))  # 上映地区
     release_time = db.Column(db.Date)  # 上映时间
+    release_year = db.Column(db.SmallInteger)  # 上映年份，由上映时间自动生成，用于首页按年份筛选
     length = db.Column(db.String(100))  # 播放时长
     add_time = db.Column(db.DateTime, index=True, default=datetime.now())  # 添加时间
     comments = db.relationship('Comment', backref='movie')  # 用户评论外键关系关联
@@ -88,13 +103,21 @@ class Movie(db.Model):
     def __repr__(self):
         return "<Movie %r>" % self.title
 
+    @validates('release_time')
+    def validate_release_time(self, key, release_time):
+        """修改上映时间的同时更新上映年份，表单提交的上映时间为yyyy-mm-dd格式的字符串"""
+        if isinstance(release_time, str):
+            release_time = datetime.strptime(release_time, '%Y-%m-%d').date()
+        self.release_year = release_time.year if release_time else None
+        return release_time
+
 
 class Preview(db.Model):
     __tablename__ = 'preview'
     # __table_args__ = {"useexisting": True}
     id = db.Column(db.Integer, primary_key=True)  # 编号
     title = db.Column(db.String(255), unique=True)  # 标题
-    logo = db.Column(db.String(255), unique=True)  # 封面
+    logo = db.Column(db.String(255))  # 封面
     add_time = db.Column(db.DateTime, index=True, default=datetime.now())  # 添加时间
 
     def __repr__(self):
@@ -105,6 +128,11 @@ class Preview(db.Model):
 class Comment(db.Model):
     __tablename__ = 'comment'
     # __table_args__ = {"useexisting": True}
+    # 电影评论和个人评论按照(add_time, id)游标分页，需要联合索引
+    __table_args__ = (
+        db.Index('ix_comment_movie_id_add_time', 'movie_id', 'add_time', 'id'),
+        db.Index('ix_comment_user_id_add_time', 'user_id', 'add_time', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     content = db.Column(db.Text)  # 评论内容
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # 所属电影，在movie表中创建关联
@@ -119,6 +147,8 @@ class Comment(db.Model):
 class MovieCollect(db.Model):
     __tablename__ = 'moviecollect'
     # __table_args__ = {"useexisting": True}
+    # 个人收藏按照(add_time, id)游标分页，需要联合索引
+    __table_args__ = (db.Index('ix_moviecollect_user_id_add_time', 'user_id', 'add_time', 'id'),)
     id = db.Column(db.Integer, primary_key=True)  # 编号
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # 所属电影，在movie表中创建关联
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 所属用户，在user表中创建外键关联
@@ -165,8 +195,10 @@ class Admin(db.Model):
     is_super = db.Column(db.SmallInteger)  # 是否为超级管理员，0为超级管理员
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))  # 所属角色
     add_time = db.Column(db.DateTime, index=True, default=datetime.now())  # 添加时间
-    adminlogs = db.relationship('AdminLog', backref='admin')  # 管理员日志外键关系关联，backref互相绑定admin表
-    operatelogs = db.relationship('OperateLog', backref='admin')  # 管理员操作日志外键关系关联
+    adminlogs = db.relationship('AdminLog', primaryjoin='Admin.id == foreign(AdminLog.admin_id)',
+                                backref='admin')  # 管理员日志关系关联，backref互相绑定admin表
+    operatelogs = db.relationship('OperateLog', primaryjoin='Admin.id == foreign(OperateLog.admin_id)',
+                                  backref='admin')  # 管理员操作日志关系关联
 
     def __repr__(self):  # 查询的时候返回
         return "<Admin %r>" % self.name
@@ -182,7 +214,7 @@ class AdminLog(db.Model):
     __tablename__ = "adminlog"
     # __table_args__ = {"useexisting": True}
     id = db.Column(db.Integer, primary_key=True)  # 编号
-    admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'))  # 所属管理员
+    admin_id = db.Column(db.Integer)  # 所属管理员
     ip = db.Column(db.String(100))  # 登录IP
     add_time = db.Column(db.DateTime, index=True, default=datetime.now())  # 登录时间
 
@@ -195,7 +227,7 @@ class OperateLog(db.Model):
     __tablename__ = "operatelog"
     # __table_args__ = {"useexisting": True}
     id = db.Column(db.Integer, primary_key=True)  # 编号
-    admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'))  # 所属管理员
+    admin_id = db.Column(db.Integer)  # 所属管理员
     ip = db.Column(db.String(100))  # 登录ip
     reason = db.Column(db.String(600))  # 操作原因
     add_time = db.Column(db.DateTime, index=True, default=datetime.now())  # 时间
@@ -204,6 +236,38 @@ class OperateLog(db.Model):
         return "Operatelog %r" % self.id
 
 
+# 日志每日汇总：每个会员每天的登录次数、每个管理员每天的登录和操作次数，原始日志过期删除后仍然保留
+class LogDaily(db.Model):
+    __tablename__ = "logdaily"
+    day = db.Column(db.Date, primary_key=True)  # 日期
+    kind = db.Column(db.String(20), primary_key=True)  # 日志表名：userlog、adminlog、operatelog
+    owner_id = db.Column(db.Integer, primary_key=True)  # 会员id或者管理员id
+    num = db.Column(db.Integer)  # 次数
+
+    def __repr__(self):
+        return "<LogDaily %r %r %r>" % (self.day, self.kind, self.owner_id)
+
+
+# 已经写入数据库的播放量批次，和播放量在同一个事务中写入，同一批增量重复写入时跳过
+class PlayNumFlush(db.Model):
+    __tablename__ = "playnumflush"
+    batch = db.Column(db.String(32), primary_key=True)  # 批次编号
+    add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # 写入时间
+
+    def __repr__(self):
+        return "<PlayNumFlush %r>" % self.batch
+
+
+# 已经写入数据库的日志批次，和日志在同一个事务中写入，同一批日志重复写入时跳过
+class LogFlush(db.Model):
+    __tablename__ = "logflush"
+    batch = db.Column(db.String(32), primary_key=True)  # 批次编号
+    add_time = db.Column(db.DateTime, index=True, default=datetime.now)  # 写入时间
+
+    def __repr__(self):
+        return "<LogFlush %r>" % self.batch
+
+
 if __name__ == '__main__':
     """如果要执行下面的代码，需要把此文件上面关于SQLAlchemy的代码取消注释
     并且从app导入app，否则或出现user表已存在的问题。我猜测问题可能是各种配置文件和导入的包都需要设置和执行
@@ -216,8 +280,8 @@ if __name__ == '__main__':
     # # 添加角色
     # role = Role(
     #     name="超级管理员",
-          # 所有的权限一共32种
-    #     auths="1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32",
+          # 所有的权限一共35种
+    #     auths="1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35",
     # )
     # db.session.add(role)
     # db.session.commit()
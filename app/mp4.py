@@ -0,0 +1,302 @@
+import bisect
+import json
+import os
+import struct
+from app import jobs
+
+# 需要展开解析的容器box，只解析到stbl，其他box原样保留
+CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+# 复制文件时的缓冲大小
+BUFFER_SIZE = 1024 * 1024
+# 关键帧索引文件的后缀，保存在视频文件旁边
+INDEX_SUFFIX = '.idx'
+
+
+class MP4Error(Exception):
+    """文件不是mp4或者结构无法处理"""
+
+
+def _top_boxes(f):
+    """扫描文件顶层的box，返回[(类型, 起始位置, 大小)]"""
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        if size == 1:
+            size, = struct.unpack('>Q', f.read(8))  # 64位大小
+        elif size == 0:
+            size = file_size - offset  # 一直到文件结尾
+        if size < 8 or offset + size > file_size:
+            raise MP4Error('box大小不正确')
+        boxes.append((box_type, offset, size))
+        offset += size
+    return boxes
+
+
+def _parse(data):
+    """把box数据解析为[[类型, 子box列表或者原始内容]]"""
+    boxes = []
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size, = struct.unpack_from('>Q', data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header:
+            raise MP4Error('box大小不正确')
+        body = data[offset + header:offset + size]
+        boxes.append([box_type, _parse(body) if box_type in CONTAINERS else body])
+        offset += size
+    return boxes
+
+
+def _build(boxes):
+    """_parse的逆操作，重新生成box数据"""
+    result = []
+    for box_type, body in boxes:
+        if box_type in CONTAINERS:
+            body = _build(body)
+        result.append(struct.pack('>I4s', len(body) + 8, box_type) + body)
+    return b''.join(result)
+
+
+def _find(boxes, *path):
+    """按照路径查找box，返回第一个匹配的box"""
+    for box in boxes:
+        if box[0] == path[0]:
+            if len(path) == 1:
+                return box
+            found = _find(box[1], *path[1:])
+            if found is not None:
+                return found
+    return None
+
+
+def _chunk_offset_boxes(moov):
+    """返回所有轨道的stco/co64 box"""
+    result = []
+    for trak in moov:
+        if trak[0] != b'trak':
+            continue
+        stbl = _find(trak[1], b'mdia', b'minf', b'stbl')
+        for box in stbl[1] if stbl else []:
+            if box[0] in (b'stco', b'co64'):
+                result.append(box)
+    return result
+
+
+def _read_offsets(box):
+    """读取stco/co64中的分块偏移"""
+    count, = struct.unpack_from('>I', box[1], 4)
+    fmt = '>{}{}'.format(count, 'I' if box[0] == b'stco' else 'Q')
+    return list(struct.unpack_from(fmt, box[1], 8))
+
+
+def _write_offsets(box, offsets):
+    """写回分块偏移，32位放不下时改为co64"""
+    if box[0] == b'stco' and offsets and max(offsets) > 0xFFFFFFFF:
+        box[0] = b'co64'
+    fmt = '>{}{}'.format(len(offsets), 'I' if box[0] == b'stco' else 'Q')
+    box[1] = box[1][:4] + struct.pack('>I', len(offsets)) + struct.pack(fmt, *offsets)
+
+
+def _relocate(moov, mdat_start, moov_start, moov_end):
+    """moov移动到第一个mdat前面后，修正所有分块偏移，返回新的moov数据
+    原来在mdat和moov之间的数据后移新moov的大小，原来在moov后面的数据后移新旧moov的大小差
+    """
+    boxes = _chunk_offset_boxes(moov)
+    original = [_read_offsets(box) for box in boxes]
+    data = _build(moov)
+    while True:
+        size = len(data) + 8
+        for box, offsets in zip(boxes, original):
+            _write_offsets(box, [
+                offset + size if mdat_start <= offset < moov_start else
+                offset + size - (moov_end - moov_start) if offset >= moov_end else offset
+                for offset in offsets
+            ])
+        new_data = _build(moov)
+        if len(new_data) == len(data):
+            return new_data  # 改为co64后moov会变大，需要重新计算直到大小不再变化
+        data = new_data
+
+
+def _copy(src, dst, start, size):
+    src.seek(start)
+    while size > 0:
+        data = src.read(min(BUFFER_SIZE, size))
+        if not data:
+            raise MP4Error('文件不完整')
+        dst.write(data)
+        size -= len(data)
+
+
+def faststart(path):
+    """把moov移动到mdat前面，播放器不需要先下载文件结尾就能开始播放
+    返回是否重写了文件，已经是faststart的文件不做修改，不是mp4时抛出MP4Error
+    """
+    with open(path, 'rb') as f:
+        boxes = _top_boxes(f)
+        types = [box[0] for box in boxes]
+        if b'moov' not in types or b'mdat' not in types:
+            raise MP4Error('不是mp4文件')
+        moov_index = types.index(b'moov')
+        mdat_index = types.index(b'mdat')
+        if moov_index < mdat_index:
+            return False
+        _, moov_start, moov_size = boxes[moov_index]
+        f.seek(moov_start)
+        moov = _parse(f.read(moov_size))[0][1]
+        if _find(moov, b'cmov'):
+            raise MP4Error('不支持压缩的moov')
+        moov_data = _relocate(moov, boxes[mdat_index][1], moov_start, moov_start + moov_size)
+
+        # 写入同目录的临时文件，完成后直接改名替换原文件
+        tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.faststart')
+        try:
+            with open(tmp_path, 'wb') as out:
+                for i, (box_type, start, size) in enumerate(boxes):
+                    if i == mdat_index:
+                        out.write(struct.pack('>I4s', len(moov_data) + 8, b'moov') + moov_data)
+                    if i != moov_index:
+                        _copy(f, out, start, size)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+    return True
+
+
+def _full_box(box):
+    """full box的内容：跳过版本和标志"""
+    return box[1][4:] if box else None
+
+
+def _table(box, fmt):
+    """读取entry_count开头的表，fmt为每一项的格式"""
+    if box is None:
+        return None
+    body = _full_box(box)
+    count, = struct.unpack_from('>I', body)
+    size = struct.calcsize('>' + fmt)
+    return [struct.unpack_from('>' + fmt, body, 4 + i * size) for i in range(count)]
+
+
+def _video_track(moov):
+    """返回第一个视频轨道的mdia box"""
+    for trak in moov:
+        if trak[0] != b'trak':
+            continue
+        mdia = _find(trak[1], b'mdia')
+        hdlr = _find(mdia[1], b'hdlr') if mdia else None
+        if hdlr and hdlr[1][8:12] == b'vide':
+            return mdia
+    return None
+
+
+def keyframes(moov):
+    """计算视频轨道每个关键帧的(时间(秒), 文件偏移)，没有视频轨道时返回(时长, [])"""
+    mdia = _video_track(moov)
+    if mdia is None:
+        return 0, []
+    mdhd = _find(mdia[1], b'mdhd')
+    if mdhd[1][0] == 1:
+        timescale, duration = struct.unpack_from('>IQ', mdhd[1], 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', mdhd[1], 12)
+    stbl = _find(mdia[1], b'minf', b'stbl')[1]
+
+    # 每个样本的解码时间
+    times = []
+    elapsed = 0
+    for count, delta in _table(_find(stbl, b'stts'), 'II'):
+        for _ in range(count):
+            times.append(elapsed)
+            elapsed += delta
+
+    # 每个样本的大小
+    stsz = _full_box(_find(stbl, b'stsz'))
+    sample_size, sample_count = struct.unpack_from('>II', stsz)
+    if sample_size:
+        sizes = [sample_size] * sample_count
+    else:
+        sizes = list(struct.unpack_from('>{}I'.format(sample_count), stsz, 8))
+
+    # 根据分块偏移和每个分块的样本数计算每个样本的文件偏移
+    chunk_box = _find(stbl, b'stco') or _find(stbl, b'co64')
+    chunks = _read_offsets(chunk_box)
+    stsc = _table(_find(stbl, b'stsc'), 'III')
+    offsets = []
+    for i, (first_chunk, samples_per_chunk, _) in enumerate(stsc):
+        last_chunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunks)
+        for chunk in range(first_chunk - 1, last_chunk):
+            offset = chunks[chunk]
+            for _ in range(samples_per_chunk):
+                offsets.append(offset)
+                offset += sizes[len(offsets) - 1]
+
+    # 没有stss时所有样本都是关键帧
+    stss = _table(_find(stbl, b'stss'), 'I')
+    sync = [number for number, in stss] if stss is not None else range(1, len(offsets) + 1)
+    result = [
+        (round(times[number - 1] / timescale, 3), offsets[number - 1])
+        for number in sync if number <= len(offsets) and number <= len(times)
+    ]
+    return round(duration / timescale, 3), result
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_index(path):
+    """读取moov生成关键帧索引，保存为视频文件旁边的json文件：{"duration": 时长, "keyframes": [[时间, 偏移]]}"""
+    with open(path, 'rb') as f:
+        for box_type, start, size in _top_boxes(f):
+            if box_type == b'moov':
+                f.seek(start)
+                moov = _parse(f.read(size))[0][1]
+                break
+        else:
+            raise MP4Error('不是mp4文件')
+    duration, frames = keyframes(moov)
+    with open(index_path(path), 'w') as f:
+        json.dump({'duration': duration, 'keyframes': frames}, f, separators=(',', ':'))
+    return len(frames)
+
+
+@jobs.task
+def process(path):
+    """上传完成后的处理：faststart和生成关键帧索引，不是mp4的文件不处理，返回是否处理"""
+    if not os.path.exists(path):
+        return False  # 处理之前文件已经被删除
+    try:
+        faststart(path)
+        build_index(path)
+    except (MP4Error, struct.error, IndexError, TypeError):
+        return False
+    return True
+
+
+def remove_index(path):
+    """删除视频文件时同时删除关键帧索引"""
+    if os.path.exists(index_path(path)):
+        os.remove(index_path(path))
+
+
+def seek(path, t):
+    """返回时间t(秒)之前最近的关键帧(时间, 偏移)，没有索引时返回None"""
+    if not os.path.exists(index_path(path)):
+        return None
+    with open(index_path(path)) as f:
+        frames = json.load(f)['keyframes']
+    if not frames:
+        return None
+    i = bisect.bisect_right([frame[0] for frame in frames], t) - 1
+    return tuple(frames[max(i, 0)])
@@ -0,0 +1,116 @@
+import hashlib
+import time
+from functools import wraps
+from flask import current_app, g, request, session, make_response
+from flask_wtf.csrf import generate_csrf
+from werkzeug.urls import url_encode
+from app import rd
+
+# 未登录用户看到的首页、播放页和搜索页完全相同，整页html缓存在redis中，所有访客共用
+# 登录用户、POST请求以及有闪现消息的请求不使用缓存
+# 页面中每个访客不同的部分(表单的csrf token)在缓存中保存为占位符，返回时替换为当前访客的值
+
+# 页面缓存，键为路径和排序后的查询参数的md5
+PAGE_KEY = "page:{}"
+# 生成页面的锁，同一个页面同时只有一个请求渲染，其他请求等待结果
+PAGE_LOCK_KEY = "page:lock:{}"
+# csrf token的占位符
+CSRF_PLACEHOLDER = "__page_cache_csrf_token__"
+# 每次请求都不同的部分(例如播放量)的占位符，模板中使用hole(name)，返回时替换为serve的holes参数中的值
+HOLE_PLACEHOLDER = "__page_cache_hole_{}__"
+
+
+def _cacheable():
+    return (request.method == 'GET' and current_app.config['PAGE_CACHE_TIMEOUT']
+            and 'login_user' not in session and '_flashes' not in session)
+
+
+def _key():
+    """路径、排序后的查询参数以及conditional计算的页面版本(数据修改后变化)，数据修改后不会返回修改前的页面"""
+    query = url_encode(sorted(request.args.items(multi=True)))
+    version = g.get('page_version', '')
+    return PAGE_KEY.format(hashlib.md5((request.path + '?' + query + '#' + version).encode()).hexdigest())
+
+
+def hole(name):
+    """模板中每次请求都不同的部分，缓存中保存为占位符"""
+    return HOLE_PLACEHOLDER.format(name)
+
+
+def _fill(body, holes):
+    """把占位符替换为holes中的值，body不是页面(例如重定向)时直接返回"""
+    if not holes or not isinstance(body, (str, bytes)):
+        return body
+    for name, value in holes.items():
+        placeholder, value = hole(name), str(value)
+        if isinstance(body, bytes):
+            placeholder, value = placeholder.encode(), value.encode()
+        body = body.replace(placeholder, value)
+    return body
+
+
+def _render_and_store(key, render):
+    """渲染页面，页面中当前访客的csrf token替换为占位符后写入缓存；render返回的不是页面(例如重定向)时直接返回"""
+    result = render()
+    if not isinstance(result, str):
+        return result
+    body = result.encode()
+    # 表单创建或渲染时生成的token保存在g中
+    token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    cached_body = body.replace(token.encode(), CSRF_PLACEHOLDER.encode()) if token else body
+    rd.setex(key, current_app.config['PAGE_CACHE_TIMEOUT'], cached_body)
+    return cached_body
+
+
+def _render_once(key, render):
+    """缓存中没有时只让一个请求渲染页面，其他请求等待渲染结果，等待超时后自己渲染"""
+    lock_key = PAGE_LOCK_KEY.format(key)
+    if rd.set(lock_key, 1, nx=True, ex=current_app.config['PAGE_CACHE_LOCK_TIMEOUT']):
+        try:
+            return _render_and_store(key, render)
+        finally:
+            rd.delete(lock_key)
+    deadline = time.time() + current_app.config['PAGE_CACHE_LOCK_TIMEOUT']
+    while time.time() < deadline:
+        time.sleep(0.05)
+        body = rd.get(key)
+        if body is not None:
+            return body
+        if not rd.exists(lock_key):
+            break  # 渲染的请求失败或者页面不需要缓存
+    return _render_and_store(key, render)
+
+
+def _punch(body):
+    """把占位符替换为当前访客的csrf token"""
+    placeholder = CSRF_PLACEHOLDER.encode()
+    if placeholder in body:
+        body = body.replace(placeholder, generate_csrf().encode())
+    return body
+
+
+def serve(render, holes=None):
+    """未登录用户的GET请求返回缓存的页面，缓存中没有时调用render()生成，其他请求直接返回render()
+    holes为{名称: 值}，页面中hole(名称)的占位符替换为对应的值
+    """
+    if not _cacheable():
+        return _fill(render(), holes)
+    key = _key()
+    body = rd.get(key)
+    status = 'HIT'
+    if body is None:
+        body = _render_once(key, render)
+        if not isinstance(body, bytes):
+            return body
+        status = 'MISS'
+    resp = make_response(_fill(_punch(body), holes))
+    resp.headers['X-Page-Cache'] = status
+    return resp
+
+
+def cached(func):
+    """视图装饰器：整个视图使用页面缓存"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return serve(lambda: func(*args, **kwargs))
+    return wrapper
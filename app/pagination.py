@@ -0,0 +1,123 @@
+import math
+from datetime import datetime
+from flask import request
+from sqlalchemy import and_, or_
+
+# 游标中时间的格式，精确到微秒，保证同一秒内的记录也能区分
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def encode_cursor(item):
+    """将一条记录的(add_time, id)编码为游标字符串"""
+    return "{}_{}".format(item.add_time.strftime(CURSOR_TIME_FORMAT), item.id)
+
+
+def decode_cursor(cursor):
+    """将游标字符串解析为(add_time, id)，格式不正确时返回None"""
+    try:
+        add_time, item_id = cursor.split('_')
+        return datetime.strptime(add_time, CURSOR_TIME_FORMAT), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class CursorPagination(object):
+    """游标分页结果，属性和Flask-SQLAlchemy的Pagination保持一致，模板中可以直接使用items、has_prev、has_next等
+    total和pages只有在开启精确计数时才有值，否则为None
+    """
+
+    def __init__(self, items, page, per_page, has_prev, has_next, total=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.total = total
+
+    @property
+    def pages(self):
+        """总页数，未计数时为None"""
+        if self.total is None:
+            return None
+        return max(int(math.ceil(self.total / float(self.per_page))), 1)
+
+    @property
+    def prev_num(self):
+        """上一页的页码，仅用于显示"""
+        if not self.has_prev or not self.page:
+            return None
+        return self.page - 1
+
+    @property
+    def next_num(self):
+        """下一页的页码，仅用于显示"""
+        if not self.has_next or not self.page:
+            return None
+        return self.page + 1
+
+    @property
+    def prev_cursor(self):
+        """上一页的游标：当前页第一条记录"""
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor(self.items[0])
+
+    @property
+    def next_cursor(self):
+        """下一页的游标：当前页最后一条记录"""
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(self.items[-1])
+
+
+def cursor_paginate(query, model, page=1, per_page=10, desc=True, with_count=False):
+    """按照(add_time, id)进行游标分页，代替paginate的OFFSET扫描和COUNT，任意一页的开销都和第一页相同
+    请求参数after为下一页游标，before为上一页游标，last=1为最后一页；都没有时按照页码查询（兼容旧链接）
+    游标链接中同时带上推算的页码，没有计数时尾页及从尾页翻出的页面不知道页码，page为None
+    with_count为True时才会执行COUNT查询，用于显示总数和总页数
+    """
+    order_time, order_id = model.add_time, model.id
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before'))
+    last = request.args.get('last') == '1'
+    if after or before or last:
+        page = page or None  # 游标链接中的页码为0表示不知道是第几页(从没有计数的尾页翻过来)，不显示页码
+    elif not page:
+        page = 1
+
+    total = query.order_by(None).count() if with_count else None
+
+    def seek(cursor, forward):
+        """forward为True时查找排序方向上游标之后的记录，否则查找之前的记录"""
+        add_time, item_id = cursor
+        if forward == desc:
+            return or_(order_time < add_time, and_(order_time == add_time, order_id < item_id))
+        return or_(order_time > add_time, and_(order_time == add_time, order_id > item_id))
+
+    def ordered(forward):
+        if forward == desc:
+            return query.order_by(order_time.desc(), order_id.desc())
+        return query.order_by(order_time.asc(), order_id.asc())
+
+    if before or last:
+        # 反向查询，多取一条用于判断是否还有上一页，然后再翻转回正常顺序
+        reverse_query = ordered(False)
+        if before:
+            reverse_query = reverse_query.filter(seek(before, False))
+        items = reverse_query.limit(per_page + 1).all()
+        has_prev = len(items) > per_page
+        items = items[:per_page][::-1]
+        has_next = bool(before)
+        if last:
+            page = total and max(int(math.ceil(total / float(per_page))), 1)
+    else:
+        forward_query = ordered(True)
+        if after:
+            forward_query = forward_query.filter(seek(after, True))
+        elif page > 1:
+            forward_query = forward_query.offset((page - 1) * per_page)
+        items = forward_query.limit(per_page + 1).all()
+        has_next = len(items) > per_page
+        items = items[:per_page]
+        has_prev = bool(after) or page > 1
+    return CursorPagination(items, page, per_page, has_prev, has_next, total)
@@ -0,0 +1,131 @@
+import hashlib
+import uuid
+from flask import current_app
+from app import rd
+
+# 倒排索引：每个字和相邻两个字(bigram)对应一个有序集合，成员为电影id，分数为权重
+GRAM_KEY = "search:gram:{}"
+# 每部电影索引了哪些字，修改或删除电影时用于从倒排索引中移除
+MOVIE_GRAMS_KEY = "search:movie:{}"
+# 搜索结果缓存，保存交集计算并核对过的结果，键中包含索引的版本号和关键字
+RESULT_KEY = "search:result:{}:{}"
+# 索引的版本号，添加、修改或删除电影时加1，之前缓存的搜索结果不再使用，自然过期
+VERSION_KEY = "search:version"
+# 每部电影去掉空白字符后的片名和简介，hash结构，字段为电影id，用于核对交集计算的结果
+TITLE_KEY = "search:title"
+INFO_KEY = "search:info"
+# 片名中出现的字权重更高，简介中出现的字权重较低
+TITLE_WEIGHT = 2
+INFO_WEIGHT = 1
+# 权重相同时按照电影id排序，id越大(越新添加)分数越高，这部分分数远小于1，不影响权重的排序
+ID_WEIGHT = 1e-10
+
+
+def _normalize(text):
+    """统一转为小写并去掉空白字符"""
+    return ''.join((text or '').lower().split())
+
+
+def grams(text):
+    """切分为单字和相邻两个字，中文片名大多较短，单字也需要能搜到"""
+    text = _normalize(text)
+    result = set(text)
+    result.update(text[i:i + 2] for i in range(len(text) - 1))
+    return result
+
+
+def _query_grams(keyword):
+    """搜索时只需要用到最长的切分：一个字时用单字，否则用全部的bigram"""
+    keyword = _normalize(keyword)
+    if len(keyword) == 1:
+        return {keyword}
+    return {keyword[i:i + 2] for i in range(len(keyword) - 1)}
+
+
+def index_movie(movie):
+    """添加或更新电影的索引，片名和简介(SEARCH_INDEX_INFO开启时)中的字都会建立索引"""
+    remove_movie(movie.id)
+    scores = {gram: TITLE_WEIGHT for gram in grams(movie.title)}
+    if current_app.config['SEARCH_INDEX_INFO']:
+        for gram in grams(movie.info):
+            scores[gram] = scores.get(gram, 0) + INFO_WEIGHT
+    scores = {gram: score + movie.id * ID_WEIGHT for gram, score in scores.items()}
+    if not scores:
+        return
+    pipe = rd.pipeline()
+    for gram, score in scores.items():
+        pipe.zadd(GRAM_KEY.format(gram), {movie.id: score})
+    pipe.sadd(MOVIE_GRAMS_KEY.format(movie.id), *scores)
+    pipe.hset(TITLE_KEY, movie.id, _normalize(movie.title))
+    if current_app.config['SEARCH_INDEX_INFO']:
+        pipe.hset(INFO_KEY, movie.id, _normalize(movie.info))
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+
+
+def remove_movie(movie_id):
+    """从索引中移除电影"""
+    movie_grams = rd.smembers(MOVIE_GRAMS_KEY.format(movie_id))
+    if not movie_grams:
+        return
+    pipe = rd.pipeline()
+    for gram in movie_grams:
+        pipe.zrem(GRAM_KEY.format(gram.decode()), movie_id)
+    pipe.delete(MOVIE_GRAMS_KEY.format(movie_id))
+    pipe.hdel(TITLE_KEY, movie_id)
+    pipe.hdel(INFO_KEY, movie_id)
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
+
+
+def _store_result(result_key, keyword, query_grams):
+    """计算所有切分的交集，关键字超过两个字时bigram都出现不代表关键字出现，核对片名和简介后再保存"""
+    keyword = _normalize(keyword)
+    tmp_key = result_key + ':' + uuid.uuid4().hex
+    rd.zinterstore(tmp_key, [GRAM_KEY.format(gram) for gram in query_grams])
+    if len(keyword) > 2:
+        movie_ids = rd.zrange(tmp_key, 0, -1)
+        if movie_ids:
+            titles = rd.hmget(TITLE_KEY, movie_ids)
+            infos = [None] * len(movie_ids)
+            if current_app.config['SEARCH_INDEX_INFO']:
+                infos = rd.hmget(INFO_KEY, movie_ids)
+            misses = [movie_id for movie_id, title, info in zip(movie_ids, titles, infos)
+                      if keyword not in (title or b'').decode() and keyword not in (info or b'').decode()]
+            if misses:
+                rd.zrem(tmp_key, *misses)
+    # 核对完成后整体改名，其他请求不会读到还没有核对的结果；结果为空时没有这个键，不需要缓存
+    if rd.exists(tmp_key):
+        pipe = rd.pipeline()
+        pipe.rename(tmp_key, result_key)
+        pipe.expire(result_key, current_app.config['SEARCH_CACHE_TIMEOUT'])
+        pipe.execute()
+
+
+def search(keyword, page=1, per_page=10):
+    """搜索电影，返回(当前页的电影id列表, 结果总数)，结果按照权重从高到低排序，权重相同时新添加的在前
+    片名(或者简介)中包含关键字才算匹配，结果缓存SEARCH_CACHE_TIMEOUT秒，翻页时不需要重新计算，电影修改后缓存失效
+    """
+    query_grams = sorted(_query_grams(keyword))
+    if not query_grams:
+        return [], 0
+    version = int(rd.get(VERSION_KEY) or 0)
+    # 切分相同的关键字(例如aba和bab)核对后的结果不同，缓存的键使用关键字本身
+    result_key = RESULT_KEY.format(version, hashlib.md5(_normalize(keyword).encode()).hexdigest())
+    if not rd.exists(result_key):
+        _store_result(result_key, keyword, query_grams)
+    start = (page - 1) * per_page
+    pipe = rd.pipeline()
+    pipe.zcard(result_key)
+    pipe.zrevrange(result_key, start, start + per_page - 1)
+    total, movie_ids = pipe.execute()
+    return [int(movie_id) for movie_id in movie_ids], total
+
+
+def rebuild(movies):
+    """重新建立全部电影的索引，用于第一次使用或者索引数据丢失时"""
+    num = 0
+    for movie in movies:
+        index_movie(movie)
+        num += 1
+    return num
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import sys
+import time
+from flask import g, request, has_request_context, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 每个请求的sql统计：执行次数、耗时，同一条sql(参数不同)重复执行多次时判断为N+1查询
+# 结果写入响应头Server-Timing，浏览器开发者工具的Timing中可以直接看到，同时输出一行json日志
+logger = logging.getLogger('app.sqlprofile')
+
+# 只记录项目中的调用位置，不记录flask、sqlalchemy等第三方库
+APP_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+THIS_FILE = os.path.abspath(__file__)
+
+
+def _call_site():
+    """返回执行sql的项目代码位置：文件:行号 函数名，模板中的调用(例如循环中访问关联属性)返回模板和block名称"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename != THIS_FILE:
+            if filename.endswith('.html'):
+                # 模板编译后的行号和模板文件的行号不一致，只记录模板和block
+                return '{} {}'.format(os.path.relpath(filename, APP_DIR), frame.f_code.co_name)
+            return '{}:{} {}'.format(os.path.relpath(filename, APP_DIR), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and current_app.config['SQL_PROFILE']:
+        conn.info.setdefault('sqlprofile_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('sqlprofile_start')
+    if not starts or not has_request_context():
+        return
+    duration = time.perf_counter() - starts.pop()
+    queries = g.setdefault('sqlprofile_queries', {})
+    # 按照sql语句和调用位置统计，同一位置反复执行同一条语句就是N+1
+    key = (statement, _call_site())
+    count, total = queries.get(key, (0, 0.0))
+    queries[key] = (count + 1, total + duration)
+
+
+def _start_request():
+    if current_app.config['SQL_PROFILE']:
+        g.sqlprofile_start = time.perf_counter()
+        g.sqlprofile_queries = {}
+
+
+def _finish_request(response):
+    start = g.get('sqlprofile_start')
+    if start is None:
+        return response
+    total = (time.perf_counter() - start) * 1000
+    queries = g.get('sqlprofile_queries', {})
+    count = sum(num for num, _ in queries.values())
+    db_time = sum(duration for _, duration in queries.values()) * 1000
+    response.headers.add(
+        'Server-Timing', 'db;dur={:.1f};desc="{} queries", app;dur={:.1f}'.format(db_time, count, total)
+    )
+    threshold = current_app.config['SQL_N_PLUS_ONE_THRESHOLD']
+    repeated = [
+        {'statement': statement, 'site': site, 'count': num, 'ms': round(duration * 1000, 1)}
+        for (statement, site), (num, duration) in queries.items() if num >= threshold
+    ]
+    data = {
+        'endpoint': request.endpoint,
+        'path': request.full_path.rstrip('?'),
+        'status': response.status_code,
+        'queries': count,
+        'db_ms': round(db_time, 1),
+        'total_ms': round(total, 1),
+    }
+    if repeated:
+        data['n_plus_one'] = sorted(repeated, key=lambda item: -item['count'])
+        response.headers['X-SQL-N-Plus-One'] = str(len(repeated))
+        logger.warning(json.dumps(data, ensure_ascii=False))
+    else:
+        logger.info(json.dumps(data, ensure_ascii=False))
+    return response
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
@@ -0,0 +1,148 @@
+import json
+import logging
+import random
+import threading
+import time
+from functools import wraps
+from redis.exceptions import LockError
+from flask import current_app
+from app import rd
+
+# 防止缓存击穿的redis缓存：
+# 1. 缓存过期后只有一个请求(拿到锁的)重新计算，其他请求等待结果，不会同时查询数据库
+# 2. 过期后在一段时间内先返回旧值，同时在后台线程重新计算
+# 3. 过期时间加上随机数，同一时间写入的缓存不会同时过期
+# 4. 不存在的数据(例如不存在的电影id)也缓存一小段时间，避免每次都查询数据库
+# 缓存的值需要可以json序列化，保存格式为{"v": 值, "t": 过期时间}，不存在的数据保存为{"n": 1, "t": 过期时间}
+
+# 重新计算时的锁
+LOCK_KEY = "stampede:lock:{}"
+# 命中、未命中、返回旧值和不存在的次数，hash结构，字段为"缓存名称:类型"
+STATS_KEY = "stampede:stats"
+
+logger = logging.getLogger('app.stampede')
+
+
+def _jitter(ttl):
+    """过期时间加上随机的上下浮动"""
+    jitter = current_app.config['CACHE_TTL_JITTER']
+    return max(ttl * random.uniform(1 - jitter, 1 + jitter), 1)
+
+
+def _count(name, event):
+    if name:
+        rd.hincrby(STATS_KEY, '{}:{}'.format(name, event), 1)
+
+
+def stats():
+    """返回{缓存名称: {'hit': 次数, 'miss': 次数, 'stale': 次数, 'negative': 次数}}"""
+    result = {}
+    for field, num in rd.hgetall(STATS_KEY).items():
+        name, event = field.decode().rsplit(':', 1)
+        result.setdefault(name, {'hit': 0, 'miss': 0, 'stale': 0, 'negative': 0})[event] = int(num)
+    return result
+
+
+def put(key, value, ttl, stale_ttl=None):
+    """写入缓存，value为None时作为不存在的数据缓存ttl秒"""
+    if stale_ttl is None:
+        stale_ttl = current_app.config['CACHE_STALE_TTL']
+    ttl = _jitter(ttl)
+    data = {'n': 1} if value is None else {'v': value}
+    data['t'] = time.time() + ttl
+    rd.setex(key, int(ttl + stale_ttl) + 1, json.dumps(data, ensure_ascii=False))
+
+
+def delete(*keys):
+    """删除缓存，下次读取时重新计算，不会返回旧值"""
+    if keys:
+        rd.delete(*keys)
+
+
+def _lock(lock_key):
+    """重新计算的锁，保存随机的token，释放时只删除自己的锁；后台线程中释放，不能使用线程本地的token"""
+    return rd.lock(lock_key, timeout=current_app.config['CACHE_LOCK_TIMEOUT'], thread_local=False)
+
+
+def _release(lock):
+    try:
+        lock.release()
+    except LockError:
+        pass  # 计算时间超过锁的时间，锁已经过期或者被其他请求拿到，不能删除
+
+
+def _load(key, loader, ttl, stale_ttl, negative_ttl):
+    value = loader()
+    if value is not None:
+        put(key, value, ttl, stale_ttl)
+    elif negative_ttl:
+        put(key, None, negative_ttl, 0)
+    return value
+
+
+def _refresh(app, key, loader, ttl, stale_ttl, negative_ttl, lock):
+    """后台线程重新计算过期的缓存"""
+    with app.app_context():
+        try:
+            _load(key, loader, ttl, stale_ttl, negative_ttl)
+        except Exception:
+            logger.exception('刷新缓存%s失败', key)
+        finally:
+            _release(lock)
+
+
+def get(key, loader, ttl, stale_ttl=None, negative_ttl=None, name=None):
+    """读取缓存，没有时调用loader()计算并缓存ttl秒
+    过期stale_ttl秒内先返回旧值并在后台重新计算；loader返回None表示数据不存在，缓存negative_ttl秒
+    name为统计命中次数时使用的缓存名称
+    """
+    if stale_ttl is None:
+        stale_ttl = current_app.config['CACHE_STALE_TTL']
+    lock_key = LOCK_KEY.format(key)
+    lock_timeout = current_app.config['CACHE_LOCK_TIMEOUT']
+    data = rd.get(key)
+    if data is not None:
+        data = json.loads(data)
+        if 'n' in data:
+            _count(name, 'negative')
+            return None
+        if data['t'] > time.time():
+            _count(name, 'hit')
+            return data['v']
+        _count(name, 'stale')
+        lock = _lock(lock_key)
+        if lock.acquire(blocking=False):
+            threading.Thread(target=_refresh, args=(
+                current_app._get_current_object(), key, loader, ttl, stale_ttl, negative_ttl, lock
+            ), daemon=True).start()
+        return data['v']
+
+    _count(name, 'miss')
+    lock = _lock(lock_key)
+    if not lock.acquire(blocking=False):
+        # 其他请求正在计算，等待结果，等待超时或者计算失败时自己计算
+        deadline = time.time() + lock_timeout
+        while True:
+            time.sleep(0.05)
+            data = rd.get(key)
+            if data is not None:
+                data = json.loads(data)
+                return None if 'n' in data else data['v']
+            if time.time() >= deadline or not rd.exists(lock_key):
+                return _load(key, loader, ttl, stale_ttl, negative_ttl)
+    try:
+        return _load(key, loader, ttl, stale_ttl, negative_ttl)
+    finally:
+        _release(lock)
+
+
+def cached(key_format, ttl, stale_ttl=None, negative_ttl=None, name=None):
+    """装饰器：key_format.format(*args)作为缓存键，例如@cached('movie:detail:{}', 3600)"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            key = key_format.format(*args)
+            return get(key, lambda: func(*args), ttl, stale_ttl, negative_ttl, name=name or func.__name__)
+        wrapper.key = lambda *args: key_format.format(*args)
+        return wrapper
+    return decorator
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import uuid
+from flask import current_app, g
+from app import jobs, rd
+
+# 上传文件按照内容的sha256保存：ab/cd/abcd...ext，相同内容只保存一份，每个目录下的文件数量也不会太多
+# 保存目录，对应的配置项
+ROOTS = {'media': 'UP_DIR', 'image': 'USER_IMAGE'}
+# 引用计数，hash结构：{目录/文件名: 引用次数}，Movie.logo、Movie.url、Preview.logo、User.face共用
+REFCOUNT_KEY = "storage:refcount"
+# 同一个文件的保存和删除需要加锁，避免刚保存的文件被另一个请求删除
+LOCK_KEY = "storage:lock:{}"
+# 已经减少过引用计数的后台任务id，任务重复执行时不再减少
+RELEASED_KEY = "storage:released:{}"
+RELEASED_TIMEOUT = 30 * 24 * 3600
+# 读取上传数据的缓冲大小
+BUFFER_SIZE = 1024 * 1024
+
+
+def path(name, root='media'):
+    """文件的完整路径"""
+    return os.path.join(current_app.config[ROOTS[root]], name)
+
+
+def _name(digest, filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return '/'.join([digest[:2], digest[2:4], digest + ext])
+
+
+def tmp_path(root='media'):
+    """同一个文件系统中的临时文件路径，保存时直接改名"""
+    tmp_dir = os.path.join(current_app.config[ROOTS[root]], '.tmp')
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    return os.path.join(tmp_dir, uuid.uuid4().hex)
+
+
+def _add(tmp, digest, filename, root):
+    """把临时文件移动到按照hash分目录的位置并增加引用计数，返回(文件名, 是否新文件)"""
+    name = _name(digest, filename)
+    file_path = path(name, root)
+    with rd.lock(LOCK_KEY.format(digest), timeout=60):
+        created = not os.path.exists(file_path)
+        if created:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(tmp, file_path)
+        else:
+            os.remove(tmp)  # 已经保存过相同内容的文件
+        rd.hincrby(REFCOUNT_KEY, root + '/' + name, 1)
+    return name, created
+
+
+def save(file_storage, root='media'):
+    """保存表单上传的文件(FileStorage)，边读取边计算hash，返回(文件名, 是否新文件)"""
+    tmp = tmp_path(root)
+    sha256 = hashlib.sha256()
+    with open(tmp, 'wb') as f:
+        for data in iter(lambda: file_storage.stream.read(BUFFER_SIZE), b''):
+            sha256.update(data)
+            f.write(data)
+    return _add(tmp, sha256.hexdigest(), file_storage.filename, root)
+
+
+def save_file(file_path, filename, digest=None, root='media'):
+    """保存已经在磁盘上的文件(分片上传完成的文件)，文件会被移动，digest为已经校验过的sha256"""
+    if not digest:
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for data in iter(lambda: f.read(BUFFER_SIZE), b''):
+                sha256.update(data)
+        digest = sha256.hexdigest()
+    tmp = tmp_path(root)
+    os.replace(file_path, tmp)
+    return _add(tmp, digest.lower(), filename, root)
+
+
+def _decrement(key):
+    """引用计数减1，返回减少后的引用次数
+    后台任务在减少计数后异常退出会重新执行，引用计数和任务id在同一个事务中写入，同一个任务只减少一次
+    """
+    job_id = g.get('job_id')
+    if not job_id:
+        return rd.hincrby(REFCOUNT_KEY, key, -1)
+    released_key = RELEASED_KEY.format(job_id)
+    if rd.exists(released_key):
+        return int(rd.hget(REFCOUNT_KEY, key) or 0)
+    pipe = rd.pipeline()
+    pipe.hincrby(REFCOUNT_KEY, key, -1)
+    pipe.setex(released_key, RELEASED_TIMEOUT, 1)
+    return pipe.execute()[0]
+
+
+@jobs.task
+def release(name, root='media'):
+    """不再使用文件时减少引用计数，没有引用时删除文件和以hash开头的衍生文件(缩略图、关键帧索引等)，返回文件是否被删除
+    以前直接保存在根目录的文件没有引用计数，直接删除
+    """
+    if not name:
+        return False
+    file_path = path(name, root)
+    if '/' not in name:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            return True
+        return False
+    digest = os.path.splitext(os.path.basename(name))[0]
+    with rd.lock(LOCK_KEY.format(digest), timeout=60):
+        if _decrement(root + '/' + name) > 0:
+            return False
+        rd.hdel(REFCOUNT_KEY, root + '/' + name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            directory = os.path.dirname(file_path)
+            for sibling in os.listdir(directory):
+                if sibling.startswith(digest + '.'):
+                    os.remove(os.path.join(directory, sibling))
+            return True
+    return False
+
+
+def rebuild_refcounts(names):
+    """根据数据库中的引用重新计算引用计数，names为[(目录, 文件名)]，返回引用的文件数量"""
+    counts = {}
+    for root, name in names:
+        if name and '/' in name:
+            key = root + '/' + name
+            counts[key] = counts.get(key, 0) + 1
+    pipe = rd.pipeline()
+    pipe.delete(REFCOUNT_KEY)
+    if counts:
+        pipe.hmset(REFCOUNT_KEY, counts)
+    pipe.execute()
+    return len(counts)
@@ -0,0 +1,73 @@
+import os
+from flask import url_for, current_app
+from app import jobs, storage
+
+# 图片上传后在后台生成多个宽度的webp缩略图，和原图保存在同一个目录：hash.w260.webp
+# 文件名由内容决定，缩略图可以被多处共用，原图删除时一起删除
+THUMBNAIL_NAME = "{}.w{}.webp"
+# 静态文件目录下的子目录，用于生成url
+STATIC_DIRS = {'media': 'media/', 'image': 'image/'}
+
+# 本进程已经确认存在的缩略图，文件名由内容决定，存在之后不会再变化
+_exists = set()
+EXISTS_CACHE_SIZE = 100000
+
+
+def thumbnail_name(name, width):
+    return THUMBNAIL_NAME.format(os.path.splitext(name)[0], width)
+
+
+@jobs.task
+def generate(name, root='media'):
+    """生成缩略图，只生成比原图窄的宽度，返回生成的数量"""
+    from PIL import Image
+    path = storage.path(name, root)
+    if not os.path.exists(path):
+        return 0  # 生成之前图片已经被删除
+    try:
+        image = Image.open(path)
+    except IOError:
+        return 0  # 不是图片，重试也不会成功
+    num = 0
+    with image:
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for width in current_app.config['THUMBNAIL_WIDTHS']:
+            if width >= image.width:
+                continue
+            height = max(round(image.height * width / image.width), 1)
+            thumb_path = storage.path(thumbnail_name(name, width), root)
+            tmp_path = thumb_path + '.tmp'
+            image.resize((width, height), Image.LANCZOS).save(
+                tmp_path, 'WEBP', quality=current_app.config['THUMBNAIL_QUALITY'], method=4
+            )
+            os.replace(tmp_path, thumb_path)  # 生成完成后再改名，页面上不会出现不完整的图片
+            num += 1
+    return num
+
+
+def submit(name, root='media'):
+    """新上传的图片放入任务队列生成缩略图，不影响请求的响应时间"""
+    if '/' not in name:
+        return None  # 以前直接保存在根目录的文件不生成缩略图
+    return generate.delay(name, root)
+
+
+def srcset(name, root='media'):
+    """返回img标签的srcset属性，还没有生成缩略图时返回空字符串"""
+    if not name or '/' not in name:
+        return ''
+    items = []
+    for width in current_app.config['THUMBNAIL_WIDTHS']:
+        thumb = thumbnail_name(name, width)
+        key = root + '/' + thumb
+        if key not in _exists:
+            if not os.path.exists(storage.path(thumb, root)):
+                continue
+            if len(_exists) >= EXISTS_CACHE_SIZE:
+                _exists.clear()
+            _exists.add(key)
+        items.append('{} {}w'.format(url_for('static', filename=STATIC_DIRS[root] + thumb), width))
+    return ', '.join(items)
+
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from app import rd
+
+# 两级缓存：每个进程内的LRU缓存 + 所有进程共用的redis缓存，用于很少变化的小数据
+# 修改数据后调用invalidate，通过redis的发布订阅通知所有进程清除本地缓存
+
+# 每个缓存名称的版本号，hash结构，失效时加1，旧版本的redis缓存自然过期
+VERSION_KEY = "tiercache:version"
+# redis中的缓存：名称、版本号、参数
+VALUE_KEY = "tiercache:{}:v{}:{}"
+# 失效通知的频道，消息内容为缓存名称
+CHANNEL = "tiercache:invalidate"
+
+# 本进程的缓存：{(名称, 参数): (过期时间, 值)}，按照访问顺序排列，超过数量时删除最久没有访问的
+_local = OrderedDict()
+# 每个名称的失效次数，加载期间收到失效通知时不保存加载的结果
+_generations = {}
+_lock = threading.Lock()
+# 订阅失效通知的进程id，fork出的子进程需要重新启动订阅线程
+_listener_pid = None
+
+
+def _drop(name=None):
+    """清除本地缓存，name为None时全部清除"""
+    with _lock:
+        if name is None:
+            _local.clear()
+            for key in _generations:
+                _generations[key] += 1
+            return
+        for key in [key for key in _local if key[0] == name]:
+            del _local[key]
+        _generations[name] = _generations.get(name, 0) + 1
+
+
+def _listen():
+    """订阅线程：收到失效通知后清除本地缓存，连接断开时重新订阅"""
+    while True:
+        try:
+            pubsub = rd.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            _drop()  # 没有订阅期间可能错过了通知，全部清除
+            for message in pubsub.listen():
+                _drop(message['data'].decode())
+        except Exception:
+            time.sleep(1)
+
+
+def _ensure_listener():
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        _local.clear()
+    threading.Thread(target=_listen, name='tiercache-listener', daemon=True).start()
+
+
+def _load_shared(name, loader, args):
+    """从redis读取，不存在时调用loader并写入redis，版本号在加载前读取，加载期间失效的结果写入旧版本不会被读到"""
+    version = int(rd.hget(VERSION_KEY, name) or 0)
+    key = VALUE_KEY.format(name, version, ':'.join(str(arg) for arg in args))
+    data = rd.get(key)
+    if data is not None:
+        return json.loads(data)
+    value = loader(*args)
+    rd.setex(key, current_app.config['TIERCACHE_TIMEOUT'], json.dumps(value))
+    return value
+
+
+def get(name, loader, *args):
+    """读取缓存，本地没有时读取redis，redis也没有时调用loader(*args)加载，返回值需要可以json序列化"""
+    _ensure_listener()
+    key = (name, args)
+    now = time.time()
+    with _lock:
+        item = _local.get(key)
+        if item is not None and item[0] > now:
+            _local.move_to_end(key)
+            return item[1]
+        generation = _generations.get(name, 0)
+    value = _load_shared(name, loader, args)
+    with _lock:
+        if _generations.get(name, 0) == generation:
+            _local[key] = (now + current_app.config['TIERCACHE_LOCAL_TIMEOUT'], value)
+            _local.move_to_end(key)
+            while len(_local) > current_app.config['TIERCACHE_LOCAL_SIZE']:
+                _local.popitem(last=False)
+    return value
+
+
+def invalidate(*names):
+    """数据修改后调用，所有进程的本地缓存和redis缓存都会失效"""
+    pipe = rd.pipeline()
+    for name in names:
+        pipe.hincrby(VERSION_KEY, name, 1)
+        pipe.publish(CHANNEL, name)
+    pipe.execute()
+    for name in names:
+        _drop(name)
+
+
+def cached(name):
+    """装饰器：函数的结果使用两级缓存，参数作为缓存键的一部分，func.invalidate()使缓存失效"""
+    def decorator(func):
+        def wrapper(*args):
+            return get(name, func, *args)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.invalidate = lambda: invalidate(name)
+        return wrapper
+    return decorator
@@ -1,12 +1,226 @@
-from app import app
-# from flask_script import Manager
+from app import create_app
+from flask_script import Manager
+
+manager = Manager(create_app)
+# 选择配置：python manage.py -c production serve，默认读取环境变量FLASK_CONFIG
+manager.add_option('-c', '--config', dest='config', required=False, help='配置名称：development、testing或production')
+
+
+@manager.command
+def rebuild_search_index():
+    """重新建立全部电影的搜索索引"""
+    from app import search
+    from app.models import Movie
+    num = search.rebuild(Movie.query.yield_per(1000))
+    print('已建立{}部电影的搜索索引'.format(num))
+
+
+@manager.command
+def clean_uploads():
+    """删除已经过期的未完成分片上传文件"""
+    from app.admin import upload
+    num = upload.clean_expired()
+    print('已删除{}个过期的上传文件'.format(num))
+
+
+@manager.command
+def rebuild_media_refcounts():
+    """根据数据库重新计算上传文件的引用计数"""
+    from itertools import chain
+    from app import db, storage
+    from app.models import Movie, Preview, User
+    names = chain(
+        (('media', url) for url, in db.session.query(Movie.url).yield_per(1000)),
+        (('media', logo) for logo, in db.session.query(Movie.logo).yield_per(1000)),
+        (('media', logo) for logo, in db.session.query(Preview.logo).yield_per(1000)),
+        (('image', face) for face, in db.session.query(User.face).yield_per(1000)),
+    )
+    num = storage.rebuild_refcounts(names)
+    print('已重新计算{}个文件的引用计数'.format(num))
+
+
+@manager.command
+def generate_thumbnails():
+    """为已有的封面、预告和头像生成缩略图"""
+    from app import db, thumbnail
+    from app.models import Movie, Preview, User
+    names = set(('media', logo) for logo, in db.session.query(Movie.logo))
+    names.update(('media', logo) for logo, in db.session.query(Preview.logo))
+    names.update(('image', face) for face, in db.session.query(User.face) if face)
+    num = 0
+    for root, name in names:
+        if '/' in name:
+            num += thumbnail.generate(name, root)
+    print('已生成{}个缩略图'.format(num))
+
+
+def _start_worker(name, config):
+    from app import jobs
+    # 子进程创建自己的app，不共用父进程的数据库连接
+    with create_app(config).app_context():
+        jobs.work(name)
+
+
+@manager.option('-n', '--num', dest='num', type=int, default=2, help='worker进程数')
+def run_workers(num):
+    """启动执行后台任务的worker进程"""
+    import multiprocessing
+    import socket
+    from flask import current_app
+    config = current_app.config['CONFIG_NAME']
+    processes = []
+    for i in range(num):
+        # worker名称在重启后保持不变，才能找回异常退出时没有完成的任务
+        name = '{}-{}'.format(socket.gethostname(), i)
+        process = multiprocessing.Process(target=_start_worker, args=(name, config), name=name)
+        process.start()
+        processes.append(process)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+@manager.command
+def retry_dead_jobs():
+    """重新执行失败的后台任务"""
+    from app import jobs
+    num = jobs.retry_dead()
+    print('已重新放入{}个任务'.format(num))
+
+
+@manager.command
+def flush_logs():
+    """把redis中还未写入的登录日志和操作日志写入数据库"""
+    from app import logwriter
+    num = logwriter.flush()
+    print('已写入{}条日志'.format(num))
+
+
+@manager.command
+def maintain_logs():
+    """每天执行一次：汇总日志，创建新的日志分区并删除过期的分区"""
+    from app import logpartition
+    created, dropped = logpartition.maintain()
+    print('已创建{}个分区，删除{}个过期分区'.format(created, dropped))
+
+
+@manager.option('--movies', dest='movies', type=int, default=10000, help='电影数量')
+@manager.option('--users', dest='users', type=int, default=10000, help='会员数量')
+@manager.option('--comments', dest='comments', type=int, default=100000, help='评论数量')
+@manager.option('--collects', dest='collects', type=int, default=50000, help='收藏数量')
+@manager.option('--logs', dest='logs', type=int, default=100000, help='会员登录日志数量')
+@manager.option('--barrage-movies', dest='barrage_movies', type=int, default=10, help='生成弹幕的热门电影数量')
+@manager.option('--barrage', dest='barrage', type=int, default=1000, help='每部电影的弹幕数量')
+@manager.option('--seed', dest='seed_value', type=int, default=0, help='随机数种子，相同的种子生成相同的数据')
+def seed_dataset(movies, users, comments, collects, logs, barrage_movies, barrage, seed_value):
+    """生成压测用的测试数据，例如--movies 1000000 --comments 20000000 --collects 5000000"""
+    from app import benchmark, search
+    from app.models import Movie
+    first_movie, last_movie = benchmark.seed(movies=movies, users=users, comments=comments, collects=collects,
+                                             logs=logs, barrage_movies=barrage_movies, barrage=barrage,
+                                             seed_value=seed_value)
+    num = search.rebuild(Movie.query.filter(Movie.id.between(first_movie, last_movie)).yield_per(1000))
+    print('已建立{}部电影的搜索索引'.format(num))
+
+
+@manager.option('-s', '--scenarios', dest='scenarios', default=None, help='逗号分隔的场景，默认全部')
+@manager.option('-n', '--requests', dest='requests', type=int, default=200, help='每个场景的请求数')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=8, help='并发数')
+@manager.option('--url', dest='base_url', default=None, help='压测已经启动的服务，例如http://127.0.0.1:5000，默认直接调用应用')
+@manager.option('--cookie', dest='cookie', default=None, help='压测后台页面时使用的登录cookie')
+def benchmark(scenarios, requests, concurrency, base_url, cookie):
+    """压测主要页面，输出每个场景的吞吐量和p50/p95/p99延迟"""
+    from app import benchmark as bench
+    results = bench.run(scenarios.split(',') if scenarios else None, requests, concurrency, base_url, cookie)
+    for line in bench.report(results):
+        print(line)
+
+
+@manager.command
+def cache_stats():
+    """查看首页筛选结果和电影详情缓存的命中、未命中、返回旧值和不存在的次数"""
+    from app import stampede
+    print('{:<20}{:>10}{:>10}{:>10}{:>10}'.format('cache', 'hit', 'miss', 'stale', 'negative'))
+    for name, num in sorted(stampede.stats().items()):
+        print('{:<20}{hit:>10}{miss:>10}{stale:>10}{negative:>10}'.format(name, **num))
+
+
+def _run_gunicorn(app, options):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+@manager.option('-b', '--bind', dest='bind', default=None, help='监听地址，默认为SERVER_BIND配置')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None, help='worker进程数，默认为SERVER_WORKERS配置')
+def serve(bind, workers):
+    """用gunicorn启动生产环境服务器：主进程加载好app后fork出多个worker，每个worker处理一定数量的请求后重启"""
+    from flask import current_app
+    from app import db
+
+    app = current_app._get_current_object()
+    config = app.config
+    # 在主进程中编译好全部模板，fork出的worker直接使用，新启动的worker不需要再编译
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    # 线程worker中每个弹幕推送连接占用一个线程，最多占用一半，推送应该由serve_stream启动的服务处理
+    config['BARRAGE_STREAM_MAX_CONNECTIONS'] = min(config['BARRAGE_STREAM_MAX_CONNECTIONS'],
+                                                   max(config['SERVER_THREADS'] // 2, 1))
+
+    def post_fork(server, worker):
+        with app.app_context():
+            db.engine.dispose()  # 不共用主进程的数据库连接
+
+    _run_gunicorn(app, {
+        'bind': bind or config['SERVER_BIND'],
+        'workers': workers or config['SERVER_WORKERS'],
+        'worker_class': 'gthread',
+        'threads': config['SERVER_THREADS'],
+        'max_requests': config['SERVER_MAX_REQUESTS'],
+        'max_requests_jitter': config['SERVER_MAX_REQUESTS_JITTER'],
+        'timeout': config['SERVER_TIMEOUT'],
+        'keepalive': config['SERVER_KEEPALIVE'],
+        'preload_app': True,
+        'post_fork': post_fork,
+    })
+
+
+@manager.option('-b', '--bind', dest='bind', default=None, help='监听地址，默认为SERVER_STREAM_BIND配置')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='worker进程数，默认为SERVER_STREAM_WORKERS配置')
+def serve_stream(bind, workers):
+    """用gunicorn的gevent worker启动弹幕推送服务，nginx把/tm/v3/stream/转发到这个服务
+    每个进程最多保持BARRAGE_STREAM_MAX_CONNECTIONS个连接，共用一个redis订阅连接
+    worker启动时替换标准库，订阅线程和每个连接的队列在worker中创建，都是协程
+    """
+    from flask import current_app
+
+    app = current_app._get_current_object()
+    config = app.config
+    _run_gunicorn(app, {
+        'bind': bind or config['SERVER_STREAM_BIND'],
+        'workers': workers or config['SERVER_STREAM_WORKERS'],
+        'worker_class': 'gevent',
+        'worker_connections': config['BARRAGE_STREAM_MAX_CONNECTIONS'] + 100,
+        'timeout': config['SERVER_TIMEOUT'],
+        'keepalive': config['SERVER_KEEPALIVE'],
+    })
 
-# manager = Manager(app)
 
 if __name__ == "__main__":
     """此项目在视频和其他人的基础上做了一些修改，以及一些bug的fix
-    如果不是本地测试，那么需要关闭app.__init__的debug调试配置
-    如果考虑管理的问题可以把本文件注释去掉，注释掉app.run()即可
+    不带参数时启动开发服务器，生产环境使用python manage.py -c production serve
+    其他管理命令可以通过python manage.py --help查看
     """
-    # manager.run()
-    app.run()
+    manager.run(default_command='runserver')
@@ -0,0 +1,5 @@
+-- 游标分页按照(add_time, id)查询，已有的数据库需要执行此文件补充联合索引，新建的数据库由db.create_all()创建
+create index ix_userlog_user_id_add_time on userlog(user_id, add_time, id);
+create index ix_comment_movie_id_add_time on comment(movie_id, add_time, id);
+create index ix_comment_user_id_add_time on comment(user_id, add_time, id);
+create index ix_moviecollect_user_id_add_time on moviecollect(user_id, add_time, id);
@@ -0,0 +1,13 @@
+-- 电影增加上映年份字段，首页按年份筛选时不再对release_time使用函数，可以走联合索引
+alter table movie add column release_year smallint after release_time;
+
+-- 回填已有电影的上映年份
+update movie set release_year = year(release_time) where release_time is not null;
+
+-- 首页筛选和排序对应的联合索引
+create index ix_movie_tag_star_year_play on movie(tag_id, star, release_year, play_num, comment_num);
+create index ix_movie_tag_year_play on movie(tag_id, release_year, play_num, comment_num);
+create index ix_movie_star_year_play on movie(star, release_year, play_num, comment_num);
+create index ix_movie_year_play on movie(release_year, play_num, comment_num);
+create index ix_movie_tag_star_add_time on movie(tag_id, star, add_time);
+create index ix_movie_star_add_time on movie(star, add_time);
@@ -0,0 +1,4 @@
+-- 上传文件按照内容保存，相同的文件可以被多部电影、多个预告和会员共用，去掉文件名的唯一约束
+alter table movie drop index url, drop index logo;
+alter table preview drop index logo;
+alter table user drop index face;
@@ -0,0 +1,23 @@
+-- 日志表按月分区，mysql的分区表不支持外键，先删除日志表的外键(外键名称以show create table的结果为准)
+alter table userlog drop foreign key userlog_ibfk_1;
+alter table adminlog drop foreign key adminlog_ibfk_1;
+alter table operatelog drop foreign key operatelog_ibfk_1;
+
+-- 分区字段会成为主键的一部分，不能为空
+update userlog set add_time = now() where add_time is null;
+update adminlog set add_time = now() where add_time is null;
+update operatelog set add_time = now() where add_time is null;
+
+-- 日志每日汇总
+create table logdaily (
+    day date not null,
+    kind varchar(20) not null,
+    owner_id int not null,
+    num int,
+    primary key (day, kind, owner_id)
+);
+
+-- 日志统计页面的权限
+insert into auth(name, url, add_time) values ("日志统计", "/admin/logs/stats/", NOW());
+
+-- 导入之后执行python manage.py maintain_logs，把日志表改为按月分区并汇总日志
@@ -0,0 +1,7 @@
+-- 播放量按批次写入数据库，记录已经写入的批次，同一批增量不会重复累加
+create table playnumflush (
+    batch varchar(32) not null,
+    add_time datetime,
+    primary key (batch),
+    index ix_playnumflush_add_time (add_time)
+);
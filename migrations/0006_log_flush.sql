@@ -0,0 +1,7 @@
+-- 日志按批次写入数据库，记录已经写入的批次，同一批日志不会重复写入
+create table logflush (
+    batch varchar(32) not null,
+    add_time datetime,
+    primary key (batch),
+    index ix_logflush_add_time (add_time)
+);
@@ -31,4 +31,7 @@ insert into auth(name, url, add_time)
 	("删除角色", "/admin/role/delete/", NOW()),
 	("角色列表", "/admin/role/list/", NOW()),
 	("添加管理员", "/admin/admin/add/", NOW()),
-	("管理员列表", "/admin/admin/list/", NOW())
\ No newline at end of file
+	("管理员列表", "/admin/admin/list/", NOW()),
+	("分片上传电影", "/admin/upload/", NOW()),
+	("续传电影分片", "/admin/upload/<upload_id>/", NOW()),
+	("日志统计", "/admin/logs/stats/", NOW())
\ No newline at end of file